@@ -0,0 +1,308 @@
+#!/router/bin/python3
+# -*- coding: utf-8 -*-
+
+# Throughput benchmark of jirafiler.py and Scrubber.py
+#
+# 1. A local NNTP server serves a synthetic group of N articles: new and
+#    old JIRA and ATTip MRs, encoded-word subjects (new MRs among them)
+#    and chatter, with quoted-printable bodies and long comment histories
+# 2. Fake findcr / addcr executables sleep for --latency seconds a call.
+#    findcr finds no ddts, so every new MR is filed
+# 3. Every script / size is run in a child process of its own, on a copy
+#    of the script and mrfiler.py in a fresh work directory, through its main()
+# 4. The report shows wall time, articles/sec, MRs filed/sec and the peak
+#    RSS of each run
+#
+# ./benchmark.py --sizes 1000 10000 100000 --json benchmark.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import fnmatch
+import argparse
+import asyncio
+import tempfile
+import resource
+import threading
+import subprocess
+import importlib.util
+
+# Scripts and group sizes benchmarked by default
+scripts = ["jirafiler", "Scrubber"]
+sizes = [1000, 10000, 100000]
+
+# Seconds each fake findcr / addcr call takes
+latency = 0.05
+
+# Number of comment lines in every article body
+commentLines = 60
+
+# Name of the synthetic group, the scripts are pointed at it
+group = "benchmark.mr"
+
+disclaimer = b"AT&T Proprietary (Internal Use Only)"
+
+fakeFindcr = """#!%s
+import os, sys, time
+time.sleep(float(os.environ.get("FAKE_CDETS_LATENCY", "0")))
+# No ddts exists for any MR
+if "-c" in sys.argv:
+	print(0)
+"""
+
+fakeAddcr = """#!%s
+import os, sys, time
+time.sleep(float(os.environ.get("FAKE_CDETS_LATENCY", "0")))
+# Filed, addcr prints nothing
+open(sys.argv[sys.argv.index("-T") + 1]).close()
+open(sys.argv[sys.argv.index("-f") + 1]).close()
+"""
+
+def articleSubject(number):
+	kind = number % 10
+	if (kind == 0):
+		return "[JIRA] Created: (MDSIADCISC-%d) Link flap on Gi0/0/%d after LC reload" % (number, number % 48)
+	elif (kind == 1):
+		return "[JIRA] created (CC-%d) Memory leak in bgpd" % number
+	elif (kind == 2):
+		return "ATTip%05d:ATT-core:New:3: BFD session down after ISSU" % (number % 100000)
+	elif (kind == 3):
+		return "[JIRA] Commented: (MDSIADCISC-%d) Link flap on Gi0/0/%d after LC reload" % (number - 3, (number - 3) % 48)
+	elif (kind == 4):
+		return "ATTip%05d:ATT-core:Open:3: BFD session down after ISSU" % ((number - 2) % 100000)
+	elif (kind == 5):
+		return "=?utf-8?q?Re=3A_Wartungsfenster_f=C3=BCr_PE%d?=" % number
+	elif (kind == 6):
+		return "=?utf-8?q?=5BJIRA=5D_Created=3A_=28MDSIADCISC-%d=29_St=C3=B6rung_auf_PE%d?=" % (number, number % 100)
+	else:
+		return "Re: weekly sync %d" % number
+
+def articleFrom(number):
+	return 'user%d@example.com ("user%d@example.com")' % (number % 500, number % 500)
+
+def articleHeader(number, field):
+	if (field == "subject"):
+		return articleSubject(number)
+	elif (field == "message-id"):
+		return "<%d@benchmark>" % number
+	return articleFrom(number)
+
+def articleBody(number):
+	kind = number % 10
+	lines = []
+	if (kind in (0, 1, 3, 6)):
+		if (kind == 6):
+			key = "MDSIADCISC-%d" % number
+		else:
+			key = articleSubject(number).split("(")[1].split(")")[0]
+		lines.append(b"Key: %s" % key.encode())
+		lines.append(b"Summary: Link flap on Gi0/0/%d after line card reload, traffic =" % (number % 48))
+		lines.append(b"drops for 30 seconds")
+	elif (kind in (2, 4)):
+		lines.append(b"MR: %s" % articleSubject(number)[:10].encode())
+		lines.append(b"Abstract: BFD session down after ISSU")
+		lines.append(b"Severity: 3")
+		lines.append(b"Summary: BFD sessions to all PEs drop after ISSU of the RP")
+	lines.append(b"=3D" * 24)
+	for comment in range(commentLines):
+		lines.append(b"Comment %d: r=C3=A9sum=C3=A9 of the traffic test on PE%d, loss stayed at =" % (comment, number % 100))
+		lines.append(b"0.0%d%% and no =E2=80=9Cunexpected=E2=80=9D resets were seen" % (comment % 10))
+	lines.append(b"=3D" * 24)
+	lines.append(disclaimer)
+	lines.append(b"This e-mail and any files transmitted with it are for the sole use of the =")
+	lines.append(b"intended recipient(s)")
+	return lines
+
+def parseRange(text, size):
+	if "-" in text:
+		(first, sep, last) = text.partition("-")
+		first = int(first)
+		last = int(last) if last else size
+	else:
+		first = last = int(text)
+	return (max(first, 1), min(last, size))
+
+async def sendLines(writer, status, lines):
+	writer.write(status + b"\r\n")
+	for (i, line) in enumerate(lines):
+		if line.startswith(b"."):
+			line = b"." + line
+		writer.write(line + b"\r\n")
+		if (i % 1000 == 999):
+			await writer.drain()
+	writer.write(b".\r\n")
+
+async def serveClient(reader, writer, size):
+	writer.write(b"200 benchmark server ready\r\n")
+	while True:
+		line = await reader.readline()
+		if not (line):
+			break
+		words = line.decode("utf-8", "replace").split()
+		if not (words):
+			continue
+		command = words[0].upper()
+		if (command == "CAPABILITIES"):
+			await sendLines(writer, b"101 Capability list", [b"VERSION 2", b"READER", b"OVER", b"HDR", b"LIST ACTIVE OVERVIEW.FMT"])
+		elif (command == "MODE"):
+			writer.write(b"200 Reader mode\r\n")
+		elif (command == "LIST"):
+			await sendLines(writer, b"215 Order of fields", [b"Subject:", b"From:", b"Date:", b"Message-ID:", b"References:", b":bytes", b":lines"])
+		elif (command == "GROUP"):
+			writer.write(b"211 %d 1 %d %s\r\n" % (size, size, group.encode()))
+		elif (command == "OVER"):
+			(first, last) = parseRange(words[1], size)
+			lines = ("%d\t%s\t%s\tMon, 1 Jan 2018 00:00:00 +0000\t<%d@benchmark>\t\t%d\t%d" % (number, articleSubject(number), articleFrom(number), number, 6000, 2 * commentLines + 8) for number in range(first, last + 1))
+			await sendLines(writer, b"224 Overview follows", (line.encode() for line in lines))
+		elif (command in ("HDR", "XHDR")):
+			field = words[1].lower()
+			(first, last) = parseRange(words[2], size)
+			await sendLines(writer, b"221 Headers follow", ((("%d %s" % (number, articleHeader(number, field))).encode()) for number in range(first, last + 1)))
+		elif (command == "XPAT"):
+			(first, last) = parseRange(words[2], size)
+			patterns = words[3:]
+			matches = []
+			for number in range(first, last + 1):
+				subject = articleSubject(number)
+				for pattern in patterns:
+					if fnmatch.fnmatchcase(subject, pattern):
+						matches.append(("%d %s" % (number, subject)).encode())
+						break
+			await sendLines(writer, b"221 Headers follow", matches)
+		elif (command == "BODY"):
+			number = int(words[1])
+			await sendLines(writer, b"222 %d <%d@benchmark> body" % (number, number), articleBody(number))
+		elif (command == "QUIT"):
+			writer.write(b"205 bye\r\n")
+			await writer.drain()
+			break
+		else:
+			writer.write(b"500 Unknown command\r\n")
+		await writer.drain()
+	writer.close()
+
+def startServer(size):
+	# Serves the synthetic group on a thread of its own, returns the port
+	started = threading.Event()
+	server = {}
+
+	async def serve():
+		srv = await asyncio.start_server(lambda reader, writer: serveClient(reader, writer, size), "127.0.0.1", 0)
+		server["port"] = srv.sockets[0].getsockname()[1]
+		started.set()
+		async with srv:
+			await srv.serve_forever()
+
+	threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+	started.wait()
+	return server["port"]
+
+def writeFakeTools(binDir):
+	for (tool, text) in (("findcr", fakeFindcr), ("addcr", fakeAddcr)):
+		file = os.path.join(binDir, tool)
+		with open(file, "w") as fh:
+			fh.write(text % sys.executable)
+		os.chmod(file, 0o755)
+
+def runOne(script, size, port, binDir, workDir, asyncMode):
+	# Runs in the child process. The script chdirs to its own directory,
+	# so its state files and log stay in workDir
+	sys.path.insert(0, workDir)
+	spec = importlib.util.spec_from_file_location(script, os.path.join(workDir, script + ".py"))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	engine = module.mrfiler
+	module.projectDict["Server"] = "127.0.0.1"
+	module.projectDict["Alias"] = group
+	engine.nntpPort = port
+	engine.cdetsBin = binDir
+	engine.ASYNC_NNTP = asyncMode
+	engine.cdetsThrottles["addcr"] = engine.setupThrottle("addcr", 0, 1, engine.cdetsConcurrency, engine.addcrLatencyTarget)
+	profile = engine.buildProfile({}, module.mrFormat)
+
+	error = ""
+	startTime = time.monotonic()
+	try:
+		module.main()
+	except SystemExit:
+		error = "main() quit, see %s.log" % profile["Name"]
+	wallTime = time.monotonic() - startTime
+
+	filed = 0
+	if os.path.exists(profile["filedMRsFile"]):
+		with open(profile["filedMRsFile"]) as fh:
+			filed = sum(1 for line in fh if line.strip())
+	return {
+		"script": script,
+		"articles": size,
+		"async": bool(asyncMode),
+		"wallTime": round(wallTime, 3),
+		"articlesPerSec": round(size / wallTime, 1),
+		"filed": filed,
+		"filedPerSec": round(filed / wallTime, 1),
+		"peakRSSMB": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+		"error": error}
+
+def runBenchmark(scriptList, sizeList, toolLatency, asyncMode, keep):
+	here = os.path.dirname(os.path.abspath(__file__))
+	baseDir = tempfile.mkdtemp(prefix="filer-benchmark-")
+	binDir = os.path.join(baseDir, "bin")
+	os.mkdir(binDir)
+	writeFakeTools(binDir)
+	env = dict(os.environ, FAKE_CDETS_LATENCY=str(toolLatency))
+
+	results = []
+	for size in sizeList:
+		port = startServer(size)
+		for script in scriptList:
+			workDir = os.path.join(baseDir, "%s-%d" % (script, size))
+			os.mkdir(workDir)
+			shutil.copy(os.path.join(here, script + ".py"), workDir)
+			shutil.copy(os.path.join(here, "mrfiler.py"), workDir)
+			child = [sys.executable, os.path.abspath(__file__), "--run-one", script, str(size), str(port), binDir, workDir, str(asyncMode)]
+			output = subprocess.check_output(child, env=env, universal_newlines=True)
+			result = json.loads(output.splitlines()[-1])
+			printResult(result)
+			results.append(result)
+
+	if (keep):
+		print("Work directories kept in %s" % baseDir)
+	else:
+		shutil.rmtree(baseDir, ignore_errors=True)
+	return results
+
+def printResult(result):
+	print("%-10s %8d articles  %8.2fs  %9.1f articles/s  %6d filed  %7.1f filed/s  %7.1f MB peak RSS  %s" % (
+		result["script"], result["articles"], result["wallTime"], result["articlesPerSec"],
+		result["filed"], result["filedPerSec"], result["peakRSSMB"], result["error"]))
+	sys.stdout.flush()
+
+def parseArgs():
+	parser = argparse.ArgumentParser(description="Throughput benchmark of the MR filers against a local NNTP server and fake CDETS tools")
+	parser.add_argument("--scripts", nargs="+", default=scripts, choices=scripts,
+		help="scripts to benchmark (default: all)")
+	parser.add_argument("--sizes", nargs="+", type=int, default=sizes, metavar="N",
+		help="number of articles in the group (default: %s)" % " ".join(map(str, sizes)))
+	parser.add_argument("--latency", type=float, default=latency, metavar="SECONDS",
+		help="seconds each findcr / addcr call takes (default %s)" % latency)
+	parser.add_argument("--async", dest="asyncMode", action="store_true",
+		help="read the group with the asyncio NNTP reader")
+	parser.add_argument("--json", metavar="FILE",
+		help="also write the results to FILE")
+	parser.add_argument("--keep", action="store_true",
+		help="keep the work directories with the state files and logs")
+	parser.add_argument("--run-one", nargs=6, help=argparse.SUPPRESS)
+	return parser.parse_args()
+
+if __name__ == "__main__":
+	args = parseArgs()
+	if (args.run_one):
+		(script, size, port, binDir, workDir, asyncMode) = args.run_one
+		print(json.dumps(runOne(script, int(size), int(port), binDir, workDir, int(asyncMode))))
+	else:
+		results = runBenchmark(args.scripts, args.sizes, args.latency, int(args.asyncMode), args.keep)
+		if (args.json):
+			with open(args.json, "w") as fh:
+				json.dump(results, fh, indent=1)
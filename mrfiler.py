@@ -0,0 +1,2745 @@
+#!/router/bin/python3
+# -*- coding: utf-8 -*-
+
+# Filer engine shared by jirafiler.py and Scrubber.py. Each of them keeps
+# its project variables, subject rules, body parser and DDTS template and
+# hands them to this module as an MR format (see setupFormat()). Reading the
+# alias, the known MR list, CDETS, the spool, the journal and the metrics
+# are the same for every format and live here.
+# The settings below apply to every filer
+
+# Logs messages to <product>.log file
+# 0 = disabled, 1 = enabled
+LOG = 1
+
+import os
+import re
+import sys
+import time
+import getpass
+import argparse
+import logging
+import sqlite3
+import zlib
+import json
+import fnmatch
+import subprocess
+import tempfile
+import configparser
+import threading
+import functools
+import importlib
+import queue
+import atexit
+import bisect
+import mailbox
+from logging import handlers
+from nntplib import NNTP
+from nntplib import decode_header
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+import math
+import asyncio
+from nntplib import ArticleInfo
+from nntplib import NNTPError
+from nntplib import NNTPTemporaryError
+from nntplib import NNTPPermanentError
+from nntplib import NNTPDataError
+
+# News Server port
+nntpPort = 119
+
+# Timeout in seconds of every NNTP connection
+nntpTimeout = 60
+
+# Number of extra NNTP reader connections used to prefetch the message
+# bodies of new MRs while earlier MRs are being filed. 0 = disabled
+bodyPoolSize = 4
+
+# Body pool connections send up to bodyPipelineWindow BODY commands back to
+# back and then read the replies in order (RFC 3977 pipelining), instead of
+# one round trip per body. Servers that get it wrong are read serially
+# 0 = disabled, 1 = enabled
+PIPELINE_BODIES = 1
+bodyPipelineWindow = 16
+
+# Fetch overviews and bodies with the asyncio NNTP reader instead of nntplib.
+# Uses bodyPoolSize body reader connections
+# 0 = disabled, 1 = enabled
+ASYNC_NNTP = 0
+
+# Maximum number of items waiting between two stages of the asyncio pipeline
+asyncQueueSize = 100
+
+# Overviews are fetched overviewWindow articles at a time on a reader
+# thread and classified as they arrive. At most overviewQueueSize windows
+# wait to be classified
+overviewWindow = 5000
+overviewQueueSize = 2
+
+# Maximum number of NNTP connections to one server shared by all
+# profiles of a multi-profile run (--profiles). It counts the main
+# connection of each profile and its body pool connections, which only
+# open while the budget has room; the other bodies are read on the main
+# connection. The asyncio readers of the aliases (ASYNC_NNTP) fit their
+# body readers and the number of aliases read at a time into it as well
+maxServerConnections = 4
+
+# Watch mode (--watch) keeps the NNTP session and the known MR list open
+# and polls the alias every watchInterval seconds. After a lost connection
+# we reconnect at once, then with exponential backoff, up to
+# watchBackoffMax seconds
+watchInterval = 60
+watchBackoffMax = 900
+
+# Subject rules of an MR format are a list of one rule per MR format:
+# (format, new MR subject pattern, [MR key patterns, tried in order],
+#  XPAT wildmat matching at least the new MR subjects)
+# A rules file (--rules) replaces them, with one section per format:
+# [<format>]
+# new = <new MR subject pattern>
+# key = <MR key patterns, one per line>
+# xpat = <XPAT wildmat>
+#
+# A rule without xpat cannot be filtered on the server, the Subject of every
+# article is fetched instead
+#
+# Number of decoded encoded-word headers (=?utf-8?...?=) we remember
+decodeCacheSize = 16384
+
+# Fetch only the Subject and From headers (HDR / XHDR) instead of full
+# overview records, and let the server pick out the new MR subjects (XPAT)
+# where it can. Servers without these commands are read with OVER
+HEADER_FILTER = 1
+
+# XPAT matches the raw Subject, before encoded-words are decoded. Every
+# XPAT request also asks for the subjects with an encoded-word, and those
+# are classified here after decoding like any other subject
+encodedWildmat = "*=?*?=*"
+
+# The other headers of XPAT matches are read with one HDR a field for each
+# run of matches. Matches up to this many articles apart share a run, the
+# articles between them are read and dropped
+headerRangeGap = 8
+
+# Fields of an overview line after the article number (RFC 3977 OVER)
+overviewFields = ['subject', 'from', 'date', 'message-id', 'references', ':bytes', ':lines']
+
+# Lines for every article that is not a new MR, or whose MR is already
+# filed, are only logged at logging.DEBUG. At logging.INFO a run logs a
+# summary of them instead
+logLevel = logging.INFO
+
+# this is to used to debug script issues
+DEBUG = 0
+CONSOLE = 0
+VERBOSE = 0
+counter = 1
+
+# following are the limits of various fields in CDETS
+cdetsHeadlineLimit = 70 	# 72 is the actual limit
+cdetsSummaryLimit = 1995 	# 2k is the actual limit
+cdetsNotesLimit = 15800		# 16k is the actual limit
+
+# The DDTS template and N-comments of each MR are written to their own
+# temp files here while addcr runs. tmpfs where we have it, None is the
+# system temp directory
+ddtsTempDir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# New DDTS are filed and findcr chunks looked up on pools of
+# cdetsMaxConcurrency threads, the throttle below decides how many calls
+# of each tool run at a time. addcr starts at addcrRate calls a second to
+# CDETS, with bursts of up to addcrBurst, findcr at findcrRate. Both are
+# then paced by the adaptive throttle.
+# A rate of 0 turns the rate limit off
+addcrRate = 2
+addcrBurst = 4
+findcrRate = 4
+findcrBurst = 4
+
+# Adaptive throttle of the findcr and addcr calls (AIMD). Every call is
+# timed. A call that fails or takes longer than the latency target of its
+# tool halves the rate and the number of concurrent calls of that tool, at
+# most once every cdetsBackoffInterval seconds. Calls that succeed in time
+# add cdetsRateStep calls a second to the rate every second, and one more
+# concurrent call, up to cdetsMaxRate and cdetsMaxConcurrency
+# 0 = fixed rate and concurrency, 1 = adaptive
+ADAPTIVE_THROTTLE = 1
+cdetsConcurrency = 4
+cdetsMaxConcurrency = 16
+cdetsMinRate = 0.1
+cdetsMaxRate = 20
+cdetsRateStep = 0.5
+cdetsBackoffInterval = 5
+findcrLatencyTarget = 10
+addcrLatencyTarget = 20
+
+# The Filed MR file is an append-only index, one MR per line, loaded into a set.
+# It is compacted at startup when more than this fraction of its lines are
+# duplicates or blank
+knownMRsCompactRatio = 0.25
+
+# Counters and per-stage timings of every run are written to the metrics
+# files of the profile, as JSON and in the Prometheus text format (node
+# exporter textfile collector). Watch mode rewrites them after every poll
+# 0 = disabled, 1 = enabled
+METRICS = 1
+
+# Upper bounds in seconds of the stage latency histogram buckets
+metricsBuckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+# Counters of a run: (name, Prometheus name, help)
+metricsCounters = [
+	("runs", "runs", "Runs of the filer"),
+	("articles", "articles_scanned", "Articles scanned"),
+	("newMRs", "new_mrs", "Articles announcing a new MR"),
+	("knownHits", "known_mr_hits", "New MR articles whose MR is in the Filed MR list"),
+	("copies", "mr_copies", "New MR articles that are copies of an earlier article of the run"),
+	("ddtsFound", "ddts_found", "MRs with a DDTS that were missing from the Filed MR list"),
+	("cdetsLookups", "cdets_lookups", "MRs looked up in CDETS"),
+	("filings", "filings", "DDTS submitted to addcr"),
+	("filed", "filed", "DDTS filed"),
+	("failures", "failures", "MRs whose CDETS lookup or filing failed"),
+	("spoolHits", "spool_hits", "Overview records and bodies served from the spool"),
+]
+
+# Plan report of the last run: every MR of the run with its canonical
+# article, the copies grouped with it and what the run does with it
+# 0 = disabled, 1 = enabled
+PLAN_REPORT = 1
+
+# CDETS backend: "cdets" runs findcr and addcr from cdetsBin, "fake" keeps
+# the records in memory and takes fakeCdetsLatency seconds a call. The fake
+# is for testing and benchmarks (--backend fake), it files nothing. Its
+# state files and logs start with fakeStatePrefix, so the MRs it "files"
+# never reach the Filed MR list or checkpoint of the real backend
+cdetsBackend = "cdets"
+cdetsBin = "/usr/cisco/bin"
+fakeCdetsLatency = 0.05
+fakeStatePrefix = "fake-"
+
+# Local spool (SQLite) of the overview records and compressed bodies we
+# fetched, keyed by alias and article number and checked against the
+# Message-ID. Reruns, replays and DEBUG sessions are served from it.
+# Bodies are evicted least recently used first above spoolMaxBytes,
+# overviews of the oldest articles above spoolMaxOverviews
+# 0 = disabled, 1 = enabled
+SPOOL = 0
+spoolMaxBytes = 268435456
+spoolMaxOverviews = 200000
+
+# Backfill (--backfill) reads mbox, Maildir or news spool archives instead
+# of the alias. Messages are classified and their bodies parsed on
+# backfillWorkers processes, backfillChunkSize messages at a time
+backfillWorkers = os.cpu_count() or 1
+backfillChunkSize = 256
+
+# Number of MRs looked up in CDETS with a single findcr query.
+# Candidate MRs of a run are resolved in chunks of this size
+findcrBatchSize = 25
+
+# Local mirror (SQLite) of the Attribute of every DDTS in this project / product.
+# When enabled, DDTS existence checks are answered from the mirror instead of findcr
+# 0 = disabled, 1 = enabled
+DDTS_MIRROR = 0
+
+# Seconds after which the mirror is refreshed incrementally from CDETS.
+# If a refresh fails and the mirror is older than this, we fall back to findcr
+ddtsMirrorRefresh = 900
+
+# Filer script of each MR format. A profile (--profiles) of another format
+# than the running script names it with "format = <format>", and gets the
+# body parser, DDTS template, subject rules and defaults of that script
+filerScripts = {"JIRA": "jirafiler", "ATTip": "Scrubber"}
+
+# The mrfiler tool involves following steps:
+# 1. Connect to Cisco mailer server
+# 2. Fetch mr alias message overviews / message count
+# 3. Fetch message headers
+# 4. Parse email "SUBJECT" to see if its new MR
+# 5. If not new MR, go back to step 2
+# 6. If new MR, check MR-Filed File to see if this is a known MR
+# 7. If known MR, go back to step 2
+# 8. If not know, check CDETS if a DDTS exists for this MR
+# 9. If exists, and if not in MR-Filed File, update the file
+# 10. If no DDTS, parse the message body to extract MR data
+# 11. Create DDTS Template
+# 12. File DDTS
+# 13. Update MR-Filed File
+
+def setupFormat(name, projectDict, subjectRules, processBody, buildDDTSTemplate, buildDDTSAttribute, attributeMatch, metricsPrefix):
+	# An MR format is what a filer script brings to the engine:
+	# projectDict - default profile settings ("Alias", "Server", "Product", ...)
+	# subjectRules - default subject rules, see compileSubjectRules()
+	# processBody(body) -> (mrDict, fullMRText)
+	# buildDDTSTemplate(projectDict, mrDict, MR) -> template text, or False
+	# buildDDTSAttribute(projectDict, mrDict, MR) -> Attribute of the DDTS
+	# attributeMatch - "Attribute LIKE" pattern of an MR, "%s" is the MR
+	# metricsPrefix - prefix of the Prometheus metric names
+	mrFormat = {}
+	mrFormat["name"] = name
+	mrFormat["projectDict"] = projectDict
+	mrFormat["subjectRules"] = subjectRules
+	mrFormat["processBody"] = processBody
+	mrFormat["buildDDTSTemplate"] = buildDDTSTemplate
+	mrFormat["buildDDTSAttribute"] = buildDDTSAttribute
+	mrFormat["attributeMatch"] = attributeMatch
+	mrFormat["metricsPrefix"] = metricsPrefix
+	return mrFormat
+
+def debugDumpHeader(id, header):
+	print("MESSAGE HEADER: Article Id: %s" % id)
+	print("=" * 80)
+	print(header)
+	print("=" * 80)
+	print("Subject: %s" % header['subject'])
+	print("=" * 80)
+	print("From: %s" % header['from'])
+	print("=" * 80)
+
+def debugDumpBody (id, body):
+	print("MESSAGE BODY: Article Id: %s" % id)
+	print("=" * 80)
+	print(body)
+	print("=" * 80)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+	# The stock QueueHandler formats every message before queueing it.
+	# We queue the record as is, so the message is only formatted on the
+	# listener thread. Log arguments must not be changed after the call
+	def prepare(self, record):
+		return record
+
+def startLogListener(*handlers):
+	# Records go on a queue and a listener thread writes them to the
+	# handlers, so a run never waits on the log file. Whatever is still
+	# queued is written out when the script exits
+	logQueue = queue.SimpleQueue()
+	listener = logging.handlers.QueueListener(logQueue, *handlers, respect_handler_level=True)
+	listener.start()
+	atexit.register(listener.stop)
+	return LazyQueueHandler(logQueue)
+
+def setupLogger(name):
+	# Each profile logs to its own <name>.log. Handlers are only added
+	# the first time, so calling this again for a profile is harmless
+	if (LOG):
+		logFile = name + ".log"
+		loggerName = name + "-file"
+		maxBytes = 2097152
+		backupCount = 5
+
+		file_logger = logging.getLogger(loggerName)
+		file_logger.setLevel(logLevel)
+
+		if not (file_logger.handlers):
+			file_handler = logging.handlers.RotatingFileHandler(logFile, maxBytes, backupCount)
+			file_formatter = logging.Formatter('%(asctime)s: %(name)s: %(levelname)s: %(message)s')
+			file_handler.setFormatter(file_formatter)
+			file_logger.addHandler(startLogListener(file_handler))
+	else:
+		file_logger = False
+
+	if (CONSOLE):
+		loggerName = name + "-console"
+		console_logger = logging.getLogger(loggerName)
+		console_logger.setLevel(logLevel)
+
+		if not (console_logger.handlers):
+			console_handler = logging.StreamHandler()
+			console_handler.setLevel(logging.DEBUG)
+			console_formatter = logging.Formatter('%(asctime)s: %(name)s: %(levelname)s: %(message)s')
+			console_handler.setFormatter(console_formatter)
+			console_logger.addHandler(startLogListener(console_handler))
+	else:
+		console_logger = False
+		
+	return file_logger, console_logger
+
+def setupMailer(server, alias, product, file_logger, console_logger, mailer=False):
+	# A connection shared between profiles is passed in as mailer,
+	# we only select our alias on it
+	try: 
+		if not (mailer):
+			mailer = NNTP(server, port=nntpPort, readermode=True, timeout=nntpTimeout)
+		(reply, count, firstMsg, lastMsg, name) = mailer.group(alias)
+		if (LOG):
+			file_logger.info('Successfully connected to Server: %s, alias: %s', server, alias)
+		return (mailer, firstMsg, lastMsg)
+	except Exception as e:
+		if (LOG):
+			file_logger.error('Error accessing alias: %s', alias, exc_info=True)
+		if (CONSOLE):
+			console_logger.error('Error accessing alias: %s', alias, exc_info=True)
+
+def setupBodyPool(server, alias, poolSize, timeout, mailerPool=False):
+	# Each worker thread of the pool opens its own reader connection
+	# on first use and keeps it until the pool is closed. In a
+	# multi-profile run the connections are taken from mailerPool
+	bodyPool = {}
+	bodyPool["server"] = server
+	bodyPool["alias"] = alias
+	bodyPool["size"] = poolSize
+	bodyPool["timeout"] = timeout
+	bodyPool["mailerPool"] = mailerPool
+	bodyPool["executor"] = ThreadPoolExecutor(max_workers=poolSize)
+	bodyPool["local"] = threading.local()
+	bodyPool["lock"] = threading.Lock()
+	bodyPool["connections"] = []
+	return bodyPool
+
+def getPoolMailer(bodyPool):
+	# A pool without a free connection of the server's budget raises,
+	# getBody() then reads the body on the main connection
+	local = bodyPool["local"]
+	if not hasattr(local, "mailer"):
+		mailerPool = bodyPool["mailerPool"]
+		if (mailerPool):
+			mailer = acquireMailer(mailerPool, bodyPool["server"], wait=False)
+			if not (mailer):
+				raise OSError("No free NNTP connection to %s" % bodyPool["server"])
+			try:
+				mailer.group(bodyPool["alias"])
+			except:
+				releaseMailer(mailerPool, bodyPool["server"], mailer, True)
+				raise
+		else:
+			mailer = NNTP(bodyPool["server"], port=nntpPort, readermode=True, timeout=bodyPool["timeout"])
+			mailer.group(bodyPool["alias"])
+		local.mailer = mailer
+		with bodyPool["lock"]:
+			bodyPool["connections"].append(local.mailer)
+	return local.mailer
+
+def dropPoolMailer(bodyPool):
+	# A connection with replies we did not read is of no use any more
+	local = bodyPool["local"]
+	with bodyPool["lock"]:
+		bodyPool["connections"].remove(local.mailer)
+	try:
+		local.mailer.sock.close()
+	except:
+		pass
+	if (bodyPool["mailerPool"]):
+		releaseMailer(bodyPool["mailerPool"], bodyPool["server"], local.mailer, True)
+	del local.mailer
+
+# Servers whose pipelined replies did not match the commands we sent,
+# their bodies are fetched one at a time from then on
+serverPipelineBroken = set()
+
+def readReplyLine(mailer):
+	line = mailer.file.readline()
+	if not (line):
+		raise EOFError("NNTP connection closed by server")
+	if line.endswith(b"\r\n"):
+		return line[:-2]
+	return line.rstrip(b"\n")
+
+def pipelineBodies(mailer, ids):
+	# Sends BODY for every id at once, then reads the replies in order.
+	# Returns {id: (resp, ArticleInfo)} like mailer.body() for each id,
+	# articles the server does not have are left out
+	mailer.file.write(b"".join(b"BODY %d\r\n" % id for id in ids))
+	mailer.file.flush()
+	bodies = {}
+	for id in ids:
+		resp = readReplyLine(mailer).decode("utf-8", "surrogateescape")
+		if resp.startswith("4"):
+			continue
+		fields = resp.split()
+		if not (resp.startswith("222")) or (len(fields) < 3) or (fields[1] != str(id)):
+			raise NNTPDataError("Reply %r to BODY %d" % (resp, id))
+		lines = []
+		while True:
+			line = readReplyLine(mailer)
+			if (line == b"."):
+				break
+			if line.startswith(b".."):
+				line = line[1:]
+			lines.append(line)
+		bodies[id] = (resp, ArticleInfo(id, fields[2], lines))
+	return bodies
+
+def fetchBodies(bodyPool, ids):
+	# Returns {id: mailer.body(id)} for a window of ids, pipelined when
+	# the server can do it. On failure the connection is dropped and the
+	# window is fetched again serially, on a new connection
+	if (PIPELINE_BODIES) and (len(ids) > 1) and (bodyPool["server"] not in serverPipelineBroken):
+		mailer = getPoolMailer(bodyPool)
+		try:
+			return pipelineBodies(mailer, ids)
+		except NNTPError as e:
+			serverPipelineBroken.add(bodyPool["server"])
+			dropPoolMailer(bodyPool)
+		except Exception as e:
+			dropPoolMailer(bodyPool)
+
+	bodies = {}
+	for id in ids:
+		try:
+			bodies[id] = getPoolMailer(bodyPool).body(id)
+		except NNTPTemporaryError as e:
+			# getBody() asks the main connection, which reports it
+			pass
+	return bodies
+
+def prefetchBodies(bodyPool, ids):
+	# Returns a dict of article id -> future of fetchBodies() of the window
+	# the id is in. Windows are kept small enough to use every connection
+	window = 1
+	if (PIPELINE_BODIES):
+		window = max(1, min(bodyPipelineWindow, math.ceil(len(ids) / bodyPool["size"])))
+	bodyFutures = {}
+	for i in range(0, len(ids), window):
+		future = bodyPool["executor"].submit(fetchBodies, bodyPool, ids[i:i + window])
+		for id in ids[i:i + window]:
+			bodyFutures[id] = future
+	return bodyFutures
+
+def getBody(mailer, bodyFutures, id):
+	# Use the prefetched body when we have one. If there is none, or the
+	# prefetch failed, we fetch it on the main connection
+	if (id in bodyFutures):
+		try:
+			return bodyFutures.pop(id).result()[id]
+		except Exception as e:
+			pass
+	return mailer.body(id)
+
+def closeBodyPool(bodyPool):
+	bodyPool["executor"].shutdown(wait=True, cancel_futures=True)
+	for mailer in bodyPool["connections"]:
+		if (bodyPool["mailerPool"]):
+			releaseMailer(bodyPool["mailerPool"], bodyPool["server"], mailer, False)
+			continue
+		try:
+			mailer.quit()
+		except:
+			pass
+
+# The asyncio NNTP reader below is an alternative to nntplib.NNTP. It only
+# implements what the filer needs: MODE READER, GROUP, OVER, BODY and QUIT.
+# Multi-line responses are parsed line by line as they arrive, so the next
+# pipeline stage can start on the first overview line
+
+async def asyncNNTPConnect(server, port, timeout):
+	(reader, writer) = await asyncio.wait_for(asyncio.open_connection(server, port, limit=1048576), timeout)
+	conn = {}
+	conn["reader"] = reader
+	conn["writer"] = writer
+	conn["timeout"] = timeout
+	# Server greeting, then switch to reader mode like NNTP(readermode=True)
+	await asyncNNTPResponse(conn)
+	await asyncNNTPCommand(conn, "MODE READER")
+	return conn
+
+async def asyncNNTPReadLine(conn):
+	line = await asyncio.wait_for(conn["reader"].readline(), conn["timeout"])
+	if not (line):
+		raise EOFError("NNTP connection closed by server")
+	if line.endswith(b"\r\n"):
+		return line[:-2]
+	return line.rstrip(b"\n")
+
+async def asyncNNTPResponse(conn):
+	line = (await asyncNNTPReadLine(conn)).decode("utf-8", "surrogateescape")
+	if line.startswith("4"):
+		raise NNTPTemporaryError(line)
+	if line.startswith("5"):
+		raise NNTPPermanentError(line)
+	return line
+
+async def asyncNNTPCommand(conn, command):
+	conn["writer"].write(command.encode("utf-8") + b"\r\n")
+	await conn["writer"].drain()
+	return await asyncNNTPResponse(conn)
+
+async def asyncNNTPLines(conn):
+	# Lines of a multi-line data block up to the terminating "."
+	# Dot-stuffed lines are unstuffed, like nntplib does
+	while True:
+		line = await asyncNNTPReadLine(conn)
+		if (line == b"."):
+			return
+		if line.startswith(b".."):
+			line = line[1:]
+		yield line
+
+async def asyncNNTPGroup(conn, alias):
+	# "211 <count> <first> <last> <group>"
+	fields = (await asyncNNTPCommand(conn, "GROUP " + alias)).split()
+	return (int(fields[1]), int(fields[2]), int(fields[3]))
+
+def parseOverviewLine(line):
+	# Same dict as nntplib.NNTP.over() returns for each article
+	fields = line.decode("utf-8", "surrogateescape").split("\t")
+	header = {}
+	for (i, name) in enumerate(overviewFields):
+		if (i + 1 < len(fields)):
+			header[name] = fields[i + 1]
+	for field in fields[len(overviewFields) + 1:]:
+		(name, sep, value) = field.partition(":")
+		header[name.lower()] = value.lstrip()
+	return (int(fields[0]), header)
+
+async def asyncNNTPOver(conn, start, end):
+	await asyncNNTPCommand(conn, "OVER %d-%d" % (start, end))
+	async for line in asyncNNTPLines(conn):
+		yield parseOverviewLine(line)
+
+async def asyncNNTPBody(conn, id):
+	# "222 <number> <message-id>"
+	resp = await asyncNNTPCommand(conn, "BODY %d" % id)
+	fields = resp.split()
+	lines = []
+	async for line in asyncNNTPLines(conn):
+		lines.append(line)
+	return (resp, ArticleInfo(id, fields[2], lines))
+
+async def asyncNNTPQuit(conn):
+	try:
+		await asyncNNTPCommand(conn, "QUIT")
+	except Exception as e:
+		pass
+	conn["writer"].close()
+
+async def asyncIngest(server, alias, checkpoint, knownMRs, rules, processBody, bodyWorkers, queueSize, timeout):
+	# Three pipeline stages connected by bounded queues:
+	# overview reader -> processHeader() -> body readers + processBody()
+	# A full queue blocks the stage feeding it, which keeps memory bounded.
+	# Returns (firstMsg, lastMsg, startMsg, classified, parsedBodies), where
+	# parsedBodies maps article id -> (body, mrDict, fullMRText) for the
+	# first article of every MR that is not in the known MR list
+	conn = await asyncNNTPConnect(server, nntpPort, timeout)
+	classified = []
+	parsedBodies = {}
+	try:
+		(count, firstMsg, lastMsg) = await asyncNNTPGroup(conn, alias)
+		startMsg = getStartMsg(checkpoint, firstMsg, lastMsg)
+		if (startMsg > lastMsg):
+			return (firstMsg, lastMsg, startMsg, classified, parsedBodies)
+
+		headerQueue = asyncio.Queue(queueSize)
+		bodyQueue = asyncio.Queue(queueSize)
+
+		async def readOverviews():
+			async for (id, header) in asyncNNTPOver(conn, startMsg, lastMsg):
+				await headerQueue.put((id, header))
+			await headerQueue.put(None)
+
+		async def classifyHeaders():
+			seenMRs = set()
+			while True:
+				item = await headerQueue.get()
+				if (item is None):
+					break
+				(id, header) = item
+				rtn = processHeader(header, id, rules)
+				classified.append((id, compactHeader(header, rtn), rtn))
+				if (bodyWorkers) and (rtn) and (rtn[0] not in knownMRs) and (rtn[0] not in seenMRs):
+					seenMRs.add(rtn[0])
+					await bodyQueue.put(id)
+			for i in range(bodyWorkers):
+				await bodyQueue.put(None)
+
+		async def readBodies():
+			# A body reader that lost its connection keeps draining the
+			# queue so the classifier never blocks. The bodies it skips
+			# are fetched later on a blocking connection
+			try:
+				bodyConn = await asyncNNTPConnect(server, nntpPort, timeout)
+				await asyncNNTPGroup(bodyConn, alias)
+			except Exception as e:
+				bodyConn = False
+			while True:
+				id = await bodyQueue.get()
+				if (id is None):
+					break
+				if not (bodyConn):
+					continue
+				try:
+					(resp, body) = await asyncNNTPBody(bodyConn, id)
+				except NNTPError as e:
+					continue
+				except Exception as e:
+					bodyConn["writer"].close()
+					bodyConn = False
+					continue
+				(mrDict, fullMRText) = processBody(body)
+				parsedBodies[id] = (body, mrDict, fullMRText)
+			if (bodyConn):
+				await asyncNNTPQuit(bodyConn)
+
+		stages = [readOverviews(), classifyHeaders()]
+		for i in range(bodyWorkers):
+			stages.append(readBodies())
+		await asyncio.gather(*stages)
+		return (firstMsg, lastMsg, startMsg, classified, parsedBodies)
+	finally:
+		await asyncNNTPQuit(conn)
+
+# Header commands each server supports, found on first use:
+# server -> {"hdr": "HDR" / "XHDR" / False, "xpat": True / False}
+serverHeaderCommands = {}
+
+def getHeaderCommands(mailer, server):
+	# HDR is announced in CAPABILITIES (RFC 3977). XHDR and XPAT are
+	# older and never announced, so they are tried and dropped on failure
+	if (server not in serverHeaderCommands):
+		commands = {"hdr": "XHDR", "xpat": True}
+		try:
+			if ("HDR" in mailer.getcapabilities()):
+				commands["hdr"] = "HDR"
+		except NNTPError:
+			pass
+		serverHeaderCommands[server] = commands
+	return serverHeaderCommands[server]
+
+def getHeaderLines(mailer, command):
+	# Returns [(id, value)] of a HDR, XHDR or XPAT reply
+	(resp, lines) = mailer._longcmdstring(command)
+	values = []
+	for line in lines:
+		(id, sep, value) = line.partition(" ")
+		values.append((int(id), value))
+	return values
+
+def getMatchRanges(ids):
+	# Groups the sorted article numbers ids into HDR ranges "first-last",
+	# or "id" alone. Matches at most headerRangeGap apart share a range
+	ranges = []
+	for id in ids:
+		if (ranges) and (id - ranges[-1][1] <= headerRangeGap + 1):
+			ranges[-1][1] = id
+		else:
+			ranges.append([id, id])
+	return [("%d-%d" % (first, last)) if first != last else str(first) for (first, last) in ranges]
+
+def fetchHeaders(mailer, server, startMsg, lastMsg, wildmats):
+	# Returns [(id, header)] for articles startMsg to lastMsg like
+	# mailer.over() does, but each header only has the subject and from.
+	# With XPAT only articles with a new MR subject are returned, with
+	# their message-id as well
+	commands = getHeaderCommands(mailer, server)
+	if not (commands["hdr"]):
+		return mailer.over((startMsg, lastMsg))[1]
+	articleRange = "%d-%d" % (startMsg, lastMsg)
+
+	subjects = False
+	if (commands["xpat"]) and all(wildmats):
+		try:
+			subjects = getHeaderLines(mailer, "XPAT Subject %s %s" % (articleRange, " ".join(wildmats + [encodedWildmat])))
+		except NNTPPermanentError:
+			commands["xpat"] = False
+
+	try:
+		if (subjects is False):
+			subjects = getHeaderLines(mailer, "%s Subject %s" % (commands["hdr"], articleRange))
+			senders = dict(getHeaderLines(mailer, "%s From %s" % (commands["hdr"], articleRange)))
+		else:
+			# The From and Message-ID (for the spool) of the matches are
+			# read with HDR over the runs of nearby matches only
+			fields = {"From": {}, "Message-ID": {}}
+			for matchRange in getMatchRanges(sorted(id for (id, subject) in subjects)):
+				for field in fields:
+					fields[field].update(getHeaderLines(mailer, "%s %s %s" % (commands["hdr"], field, matchRange)))
+			headers = []
+			for (id, subject) in subjects:
+				headers.append((id, {"subject": subject, "from": fields["From"].get(id, ""), "message-id": fields["Message-ID"].get(id, "")}))
+			return headers
+	except NNTPPermanentError:
+		commands["hdr"] = False
+		return mailer.over((startMsg, lastMsg))[1]
+
+	headers = []
+	for (id, subject) in subjects:
+		headers.append((id, {"subject": subject, "from": senders.get(id, "")}))
+	return headers
+
+def fetchOverviewWindow(mailer, server, alias, wildmats, spool, first, last, metrics):
+	if (spool):
+		return fetchSpooledHeaders(spool, mailer, server, alias, wildmats, first, last, metrics)
+	elif (HEADER_FILTER):
+		return fetchHeaders(mailer, server, first, last, wildmats)
+	else:
+		return mailer.over((first, last))[1]
+
+def streamOverviews(mailer, server, alias, wildmats, spool, startMsg, lastMsg, window, metrics):
+	# Yields the [(id, header)] of startMsg to lastMsg, one window of
+	# article numbers at a time. The next windows are fetched on a thread
+	# while the caller works on this one
+	windows = queue.Queue(overviewQueueSize)
+	stop = threading.Event()
+
+	def put(item):
+		while not (stop.is_set()):
+			try:
+				windows.put(item, timeout=1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def readWindows():
+		try:
+			for first in range(startMsg, lastMsg + 1, window):
+				headers = fetchOverviewWindow(mailer, server, alias, wildmats, spool, first, min(first + window - 1, lastMsg), metrics)
+				if not (put(headers)):
+					return
+			put(None)
+		except Exception as e:
+			put(e)
+
+	reader = threading.Thread(target=readWindows, daemon=True)
+	reader.start()
+	try:
+		while True:
+			headers = windows.get()
+			if (headers is None):
+				return
+			if isinstance(headers, Exception):
+				raise headers
+			yield headers
+	finally:
+		stop.set()
+		reader.join()
+
+class HeaderRecord:
+	# Compact overview record kept for every article of a run, read like
+	# the header dict: record["subject"], record.get("message-id").
+	# Subjects stay encoded until decodeHeader() needs them, senders are
+	# interned as the same few people send most of the mail
+	__slots__ = ("subject", "sender", "messageId")
+	fields = {"subject": "subject", "from": "sender", "message-id": "messageId"}
+
+	def __init__(self, subject, sender="", messageId=""):
+		self.subject = subject
+		self.sender = sys.intern(sender)
+		self.messageId = messageId
+
+	def __getitem__(self, name):
+		return getattr(self, HeaderRecord.fields[name])
+
+	def get(self, name, default=None):
+		if (name in HeaderRecord.fields):
+			return getattr(self, HeaderRecord.fields[name])
+		return default
+
+	def __repr__(self):
+		return "HeaderRecord(%r, %r, %r)" % (self.subject, self.sender, self.messageId)
+
+def compactHeader(header, rtn):
+	# Only what the rest of the run uses is kept for the whole run: the
+	# subject for the log, and the sender and Message-ID of new MR
+	# articles, the spool checks the Message-ID of a spooled body
+	if (DEBUG):
+		return header
+	if (rtn):
+		return HeaderRecord(header["subject"], header.get("from", ""), header.get("message-id", ""))
+	return HeaderRecord(header["subject"])
+
+def setupMailerPool(maxConnections, timeout):
+	# Idle NNTP connections per server, shared by the profiles of a
+	# multi-profile run. At most maxConnections are open to one server
+	mailerPool = {}
+	mailerPool["max"] = maxConnections
+	mailerPool["timeout"] = timeout
+	mailerPool["lock"] = threading.Lock()
+	mailerPool["idle"] = {}
+	mailerPool["slots"] = {}
+	return mailerPool
+
+def acquireMailer(mailerPool, server, wait=True):
+	# Takes a connection of the server's budget, an idle one if there is
+	# one. Without wait returns False when the budget is used up
+	with mailerPool["lock"]:
+		if (server not in mailerPool["slots"]):
+			mailerPool["slots"][server] = threading.BoundedSemaphore(mailerPool["max"])
+			mailerPool["idle"][server] = []
+		slot = mailerPool["slots"][server]
+	if not (slot.acquire(blocking=wait)):
+		return False
+	with mailerPool["lock"]:
+		if (mailerPool["idle"][server]):
+			return mailerPool["idle"][server].pop()
+	try:
+		return NNTP(server, port=nntpPort, readermode=True, timeout=mailerPool["timeout"])
+	except:
+		slot.release()
+		raise
+
+def releaseMailer(mailerPool, server, mailer, broken):
+	# Connections of a profile that failed are closed, not reused
+	if (broken):
+		try:
+			mailer.quit()
+		except:
+			pass
+	else:
+		with mailerPool["lock"]:
+			mailerPool["idle"][server].append(mailer)
+	mailerPool["slots"][server].release()
+
+def closeMailerPool(mailerPool):
+	with mailerPool["lock"]:
+		for server in mailerPool["idle"]:
+			for mailer in mailerPool["idle"][server]:
+				try:
+					mailer.quit()
+				except:
+					pass
+			mailerPool["idle"][server] = []
+
+@functools.lru_cache(maxsize=decodeCacheSize)
+def decodeEncodedHeader(header):
+	return decode_header(header)
+
+def decodeHeader(header):
+	# Plain headers are returned as is, only encoded-words are decoded.
+	# Senders and forwarded subjects repeat, so those are memoized
+	if "=?" not in header:
+		return header
+	return decodeEncodedHeader(header)
+
+def compileSubjectRules(rules):
+	# All new MR patterns are compiled into one pattern, each in its own
+	# named group, so a subject is matched once against every format.
+	# The group that matched tells us the format
+	groups = []
+	formats = {}
+	keys = {}
+	wildmats = []
+	for (i, rule) in enumerate(rules):
+		(format, newPattern, keyPatterns, wildmat) = rule
+		wildmats.append(wildmat)
+		groupName = "rule%d" % i
+		groups.append("(?P<%s>%s)" % (groupName, newPattern))
+		formats[groupName] = format
+		keys[groupName] = [re.compile(pattern) for pattern in keyPatterns]
+	compiled = {}
+	compiled["matcher"] = re.compile("|".join(groups))
+	compiled["formats"] = formats
+	compiled["keys"] = keys
+	compiled["wildmats"] = wildmats
+	return compiled
+
+def loadSubjectRules(file):
+	config = configparser.ConfigParser(interpolation=None)
+	config.optionxform = str
+	with open(file, "r") as fh:
+		config.read_file(fh)
+
+	rules = []
+	for section in config.sections():
+		# One key pattern a line, a pattern may contain spaces
+		keys = [pattern.strip() for pattern in config[section]["key"].splitlines()]
+		rules.append((section, config[section]["new"], [pattern for pattern in keys if pattern], config[section].get("xpat", "")))
+	return rules
+
+def classifySubject(subject, rules):
+	# Returns (new MR?, MR key, format) for a decoded subject
+	match = rules["matcher"].search(subject)
+	if not (match):
+		return (False, False, False)
+	rule = match.lastgroup
+	for pattern in rules["keys"][rule]:
+		key = pattern.search(subject)
+		if (key):
+			return (True, key.group(0), rules["formats"][rule])
+	return (True, False, rules["formats"][rule])
+
+def processHeader(header, id, rules):
+	subject = decodeHeader(header['subject'])
+
+	(isNew, MR, mrFormat) = classifySubject(subject, rules)
+	if (isNew):
+		if not MR:
+			return False
+		component = extractComponent(decodeHeader(header['from']))
+		return (MR, component, subject)
+	else:
+		return False
+
+def extractComponent(txt):
+	# Sample from field
+	# 'name@domain.com ("name@domain.com")'
+	# we want to extract: name
+	if "@" in txt:
+		ext = txt.split("@")
+		return ext[0]
+	else:
+		return False
+
+def extractMRName(subject, rules):
+	# MR key of any known format, key patterns are tried in rule order
+	for rule in rules["keys"]:
+		for pattern in rules["keys"][rule]:
+			match = pattern.search(subject)
+			if (match):
+				return match.group(0)
+	return False
+
+def planRun(classified):
+	# Groups the new MR articles of a run by MR key before any CDETS work.
+	# The first article of a group is the canonical one, it is the article
+	# the checkpoint, the body readers and the filing go by
+	plan = {}
+	plan["canonical"] = OrderedDict()
+	plan["copies"] = {}
+	plan["articles"] = {}
+	for (id, header, rtn) in classified:
+		if not (rtn):
+			continue
+		MR = rtn[0]
+		plan["articles"][id] = MR
+		if (MR in plan["canonical"]):
+			plan["copies"][MR].append(id)
+		else:
+			plan["canonical"][MR] = id
+			plan["copies"][MR] = []
+	return plan
+
+def formatPlanReport(plan, alias, product, knownMRs, ddtsExists):
+	# What the run does with each MR: "known" (in the Filed MR list),
+	# "ddts" (DDTS exists), "file" or "lookupFailed"
+	mrs = []
+	for (MR, id) in plan["canonical"].items():
+		if (MR in knownMRs):
+			action = "known"
+		elif (ddtsExists.get(MR) is None):
+			action = "lookupFailed"
+		elif (ddtsExists[MR]):
+			action = "ddts"
+		else:
+			action = "file"
+		mrs.append(OrderedDict([("MR", MR), ("article", id), ("copies", plan["copies"][MR]), ("action", action)]))
+	report = OrderedDict()
+	report["alias"] = alias
+	report["product"] = product
+	report["created"] = time.time()
+	report["mrs"] = mrs
+	return json.dumps(report, indent=1) + "\n"
+
+def readKnownMRs(file):
+	# Returns (set of MRs, number of lines in the file)
+	knownMRs = set()
+	lines = 0
+	try:
+		with open(file, "r") as fh:
+			for line in fh:
+				lines += 1
+				MR = line.strip()
+				if (MR):
+					knownMRs.add(MR)
+	except FileNotFoundError:
+		pass
+	return (knownMRs, lines)
+
+def compactKnownMRs(file, knownMRs):
+	# Rewrite the index with one line per MR. Same temp file + rename
+	# as the checkpoint, so a crash never leaves a truncated index
+	tmpFile = file + ".tmp"
+	with open(tmpFile, "w") as fh:
+		for MR in sorted(knownMRs):
+			fh.write(MR + "\n")
+		fh.flush()
+		os.fsync(fh.fileno())
+	os.replace(tmpFile, file)
+
+def openKnownMRs(file, compactRatio):
+	# Load the Filed MR index into a set for O(1) lookups and open it
+	# for appending new MRs
+	(knownMRs, lines) = readKnownMRs(file)
+	if (lines - len(knownMRs) > lines * compactRatio):
+		compactKnownMRs(file, knownMRs)
+	mrfh = open(file, "a")
+	return (knownMRs, mrfh)
+
+def addKnownMR(knownMRs, mrfh, MR):
+	# Each MR is flushed as soon as it is written, so it is not lost
+	# if the run dies before the file is closed
+	mrfh.write(MR + "\n")
+	mrfh.flush()
+	knownMRs.add(MR)
+
+def openJournal(file, knownMRs, mrfh):
+	# Replays the journal of the last run and starts a new one. Lines
+	# without a newline were cut short by a crash and are ignored
+	openMRs = set()
+	try:
+		with open(file, "r") as fh:
+			for line in fh:
+				if not line.endswith("\n"):
+					break
+				(kind, sep, MR) = line.strip().partition(" ")
+				if (kind == "intent"):
+					openMRs.add(MR)
+				elif (kind == "filed"):
+					openMRs.discard(MR)
+					if (MR) and (MR not in knownMRs):
+						addKnownMR(knownMRs, mrfh, MR)
+	except FileNotFoundError:
+		pass
+
+	journal = {}
+	journal["file"] = file
+	journal["fh"] = False
+	journal["lock"] = threading.Lock()
+	journal["cond"] = threading.Condition(journal["lock"])
+	journal["written"] = 0
+	journal["synced"] = 0
+	journal["syncing"] = False
+	journal["open"] = openMRs
+	checkpointJournal(journal, knownMRs, mrfh)
+	return journal
+
+def journalAppend(journal, kind, MR):
+	# Returns the sequence number of the entry for journalSync()
+	with journal["lock"]:
+		journal["fh"].write("%s %s\n" % (kind, MR))
+		if (kind == "intent"):
+			journal["open"].add(MR)
+		else:
+			journal["open"].discard(MR)
+		journal["written"] += 1
+		return journal["written"]
+
+def journalSync(journal, seq):
+	# Group commit: one thread fsyncs every entry written so far, the
+	# threads whose entries it covered return without an fsync of their own
+	with journal["cond"]:
+		while (journal["synced"] < seq):
+			if (journal["syncing"]):
+				journal["cond"].wait()
+				continue
+			journal["syncing"] = True
+			target = journal["written"]
+			fh = journal["fh"]
+			fh.flush()
+			journal["cond"].release()
+			try:
+				os.fsync(fh.fileno())
+			finally:
+				journal["cond"].acquire()
+				journal["syncing"] = False
+				journal["cond"].notify_all()
+			journal["synced"] = max(journal["synced"], target)
+
+def checkpointJournal(journal, knownMRs, mrfh):
+	# Once the Filed MR file is on disk the filed entries are not needed.
+	# The journal is rewritten with the intents that are still open, same
+	# temp file + rename as the checkpoint. Those are the MRs pending
+	# a CDETS lookup in the next run
+	mrfh.flush()
+	os.fsync(mrfh.fileno())
+	with journal["lock"]:
+		journal["open"] -= knownMRs
+		tmpFile = journal["file"] + ".tmp"
+		with open(tmpFile, "w") as fh:
+			for MR in sorted(journal["open"]):
+				fh.write("intent %s\n" % MR)
+			fh.flush()
+			os.fsync(fh.fileno())
+		os.replace(tmpFile, journal["file"])
+		if (journal["fh"]):
+			journal["fh"].close()
+		journal["fh"] = open(journal["file"], "a")
+		journal["synced"] = journal["written"]
+		journal["pending"] = set(journal["open"])
+
+def importKnownMRs(file, importFiles):
+	# One-shot import of Filed MR lists kept by older copies of this
+	# script into the index. Returns the number of MRs added
+	(knownMRs, lines) = readKnownMRs(file)
+	count = len(knownMRs)
+	for importFile in importFiles:
+		with open(importFile, "r") as fh:
+			for line in fh:
+				if line.strip():
+					knownMRs.add(line.strip())
+	compactKnownMRs(file, knownMRs)
+	return len(knownMRs) - count
+
+def getCheckpoint(file, server, alias):
+	# Checkpoint file has one line per server / alias
+	# "<server> <alias> <last fully processed article number>"
+	# No checkpoint means we process the whole group
+	try:
+		with open(file, "r") as fh:
+			for line in fh:
+				fields = line.split()
+				if (len(fields) == 3) and (fields[0] == server) and (fields[1] == alias):
+					if (fields[2].isdigit()):
+						return int(fields[2])
+	except FileNotFoundError:
+		pass
+	return 0
+
+def saveCheckpoint(file, server, alias, lastId):
+	# Other server / alias entries in the file are kept as is
+	checkpoints = OrderedDict()
+	try:
+		with open(file, "r") as fh:
+			for line in fh:
+				fields = line.split()
+				if (len(fields) == 3):
+					checkpoints[(fields[0], fields[1])] = fields[2]
+	except FileNotFoundError:
+		pass
+	checkpoints[(server, alias)] = str(lastId)
+
+	# We write the new checkpoint to a temp file, fsync it and rename it
+	# over the old one. A crash leaves either the old or the new checkpoint,
+	# never a partially written one
+	tmpFile = file + ".tmp"
+	with open(tmpFile, "w") as fh:
+		for (key, value) in checkpoints.items():
+			fh.write("%s %s %s\n" % (key[0], key[1], value))
+		fh.flush()
+		os.fsync(fh.fileno())
+	os.replace(tmpFile, file)
+
+def getStartMsg(checkpoint, firstMsg, lastMsg):
+	# First run for this alias, we process every retained article
+	if not (checkpoint):
+		return firstMsg
+	# Group was renumbered / reset on the server, the checkpoint is past
+	# the end of the group. Start over, the known MR list stops re-filing
+	if (checkpoint > lastMsg):
+		return firstMsg
+	# Articles after the checkpoint have expired and firstMsg jumped past it
+	if (checkpoint < firstMsg):
+		return firstMsg
+	return checkpoint + 1
+
+def checkIfDDTSExists(MR, project, product, attributeMatch):
+	# We'll search swtools project for
+	# any ddts with "MR" attribute
+	query = "Product = '" + product + "' and Attribute LIKE '" + attributeMatch % MR + "'"
+
+	ddts = runCdetsTool("findcr", ["-c", "-n", "-p", project, query])
+
+	if isinstance (ddts, str):
+		if (ddts.isdigit()):
+			ddts = int(ddts)
+		else:
+			return False
+
+	if (ddts):
+		return True
+	else:
+		return False
+
+def checkIfDDTSExistsChunk(chunk, project, product, attributeMatch):
+	# The "Attribute LIKE" clauses of the chunk are OR'ed together and
+	# findcr prints the Attribute of every matching ddts, one per line
+	clauses = []
+	for MR in chunk:
+		clauses.append("Attribute LIKE '" + attributeMatch % MR + "'")
+	query = "Product = '" + product + "' and (" + " or ".join(clauses) + ")"
+
+	ddts = runCdetsTool("findcr", ["-p", project, "-w", "Attribute", query])
+
+	lines = ddts.splitlines()
+	ddtsExists = {}
+	for MR in chunk:
+		ddtsExists[MR] = matchAttributes(lines, attributeMatch % MR)
+	return ddtsExists
+
+def checkIfDDTSExistsBatch(MRList, project, product, attributeMatch, batchSize):
+	# Same search as checkIfDDTSExists(), but for many MRs at once, in
+	# chunks of batchSize MRs. The chunks are queried on a pool, the findcr
+	# throttle decides how many run at a time.
+	# Returns a dict of MR -> True / False. MRs of a chunk whose query
+	# failed are left out
+	ddtsExists = {}
+	chunks = [MRList[i:i + batchSize] for i in range(0, len(MRList), batchSize)]
+	if not (chunks):
+		return ddtsExists
+	with ThreadPoolExecutor(max_workers=min(len(chunks), cdetsMaxConcurrency)) as executor:
+		futures = [executor.submit(checkIfDDTSExistsChunk, chunk, project, product, attributeMatch) for chunk in chunks]
+		for future in futures:
+			try:
+				ddtsExists.update(future.result())
+			except:
+				continue
+	return ddtsExists
+
+def runCdetsTool(tool, args):
+	# The tools are run directly, without a shell in between
+	return throttledCall(cdetsThrottles[tool], subprocess.check_output, [os.path.join(cdetsBin, tool)] + args, universal_newlines=True)
+
+def matchAttributes(attributes, pattern):
+	# "Attribute LIKE" of findcr, "*" is the only wildcard and it is case
+	# sensitive, like fnmatchcase() on the MR keys we search for
+	for attribute in attributes:
+		if fnmatch.fnmatchcase(attribute, pattern):
+			return True
+	return False
+
+def cdetsExistsMany(backend, MRList, project, product, attributeMatch):
+	# Batched lookups first, MRs whose batched query failed are asked for
+	# one at a time. MRs that could not be looked up at all are left out
+	ddtsExists = checkIfDDTSExistsBatch(MRList, project, product, attributeMatch, findcrBatchSize)
+	for MR in MRList:
+		if (MR not in ddtsExists):
+			try:
+				ddtsExists[MR] = checkIfDDTSExists(MR, project, product, attributeMatch)
+			except:
+				pass
+	return ddtsExists
+
+def cdetsCreateMany(backend, submissions):
+	# addcr files one DDTS a call
+	results = []
+	for (template, nComments) in submissions:
+		results.append(submitNewDDTS(template, nComments, ddtsTempDir))
+	return results
+
+def cdetsListRecords(backend, project, product, since):
+	# Identifier and Attribute of every ddts of the product, or only of
+	# those modified on or after since (mm/dd/yyyy)
+	query = "Product = '" + product + "'"
+	if (since):
+		query += " and Last-mod-on >= '" + since + "'"
+	ddts = runCdetsTool("findcr", ["-p", project, "-w", "Identifier,Attribute", query])
+
+	# Each line is "<Identifier> <Attribute>"
+	rows = []
+	for line in ddts.splitlines():
+		fields = line.split(None, 1)
+		if (len(fields) == 2):
+			rows.append((fields[0], fields[1]))
+	return rows
+
+def fakeExistsMany(backend, MRList, project, product, attributeMatch):
+	throttledCall(cdetsThrottles["findcr"], time.sleep, backend["latency"])
+	with backend["lock"]:
+		attributes = [attribute for (identifier, recordProduct, attribute) in backend["records"] if recordProduct == product]
+	ddtsExists = {}
+	for MR in MRList:
+		ddtsExists[MR] = matchAttributes(attributes, attributeMatch % MR)
+	return ddtsExists
+
+def fakeCreateMany(backend, submissions):
+	# One call files the whole list
+	throttledCall(cdetsThrottles["addcr"], time.sleep, backend["latency"])
+	results = []
+	with backend["lock"]:
+		for (template, nComments) in submissions:
+			fields = {}
+			for line in template.splitlines():
+				(name, sep, value) = line.partition(": ")
+				fields[name] = value
+			identifier = "CSCfk%05d" % (len(backend["records"]) + 1)
+			backend["records"].append((identifier, fields.get("Product"), fields.get("Attribute")))
+			results.append(True)
+	return results
+
+def fakeListRecords(backend, project, product, since):
+	throttledCall(cdetsThrottles["findcr"], time.sleep, backend["latency"])
+	with backend["lock"]:
+		return [(identifier, attribute) for (identifier, recordProduct, attribute) in backend["records"] if recordProduct == product]
+
+def setupCdetsBackend(kind):
+	# A backend is a dict of its state and these operations:
+	# existsMany(backend, MRList, project, product, attributeMatch) -> {MR: True / False},
+	#   MRs that could not be looked up are left out
+	# createMany(backend, [(template, nComments)]) -> [True / False]
+	# listRecords(backend, project, product, since) -> [(identifier, attribute)]
+	backend = {}
+	backend["kind"] = kind
+	if (kind == "fake"):
+		backend["latency"] = fakeCdetsLatency
+		backend["lock"] = threading.Lock()
+		backend["records"] = []
+		backend["existsMany"] = fakeExistsMany
+		backend["createMany"] = fakeCreateMany
+		backend["listRecords"] = fakeListRecords
+	else:
+		backend["existsMany"] = cdetsExistsMany
+		backend["createMany"] = cdetsCreateMany
+		backend["listRecords"] = cdetsListRecords
+	return backend
+
+cdets = setupCdetsBackend(cdetsBackend)
+
+def openSpool(file):
+	# The overview reader thread of streamOverviews() uses it while the
+	# main thread waits for the window
+	db = sqlite3.connect(file, check_same_thread=False)
+	# overview articles we hold for an alias: every article of a range is
+	# in overviews, except the ones XPAT told us are not new MRs
+	db.execute("CREATE TABLE IF NOT EXISTS ranges (alias TEXT, first INTEGER, last INTEGER)")
+	db.execute("CREATE TABLE IF NOT EXISTS overviews (alias TEXT, number INTEGER, header TEXT, PRIMARY KEY (alias, number))")
+	db.execute("CREATE TABLE IF NOT EXISTS bodies (alias TEXT, number INTEGER, messageId TEXT, body BLOB, size INTEGER, lastUsed REAL, PRIMARY KEY (alias, number))")
+	db.commit()
+	return db
+
+def getSpoolGaps(db, alias, startMsg, lastMsg):
+	# Parts of startMsg - lastMsg not covered by a spooled range
+	gaps = []
+	nextMsg = startMsg
+	for (first, last) in db.execute("SELECT first, last FROM ranges WHERE alias = ? AND last >= ? AND first <= ? ORDER BY first", (alias, startMsg, lastMsg)):
+		if (first > nextMsg):
+			gaps.append((nextMsg, first - 1))
+		nextMsg = max(nextMsg, last + 1)
+	if (nextMsg <= lastMsg):
+		gaps.append((nextMsg, lastMsg))
+	return gaps
+
+def dropRenumberedSpool(db, alias, checkpoint, lastMsg):
+	# After the group was renumbered on the server the spooled article
+	# numbers belong to other articles. It shows as a checkpoint or a
+	# spooled range past the end of the group, and then everything spooled
+	# for the alias is dropped
+	spooledLast = db.execute("SELECT MAX(last) FROM ranges WHERE alias = ?", (alias,)).fetchone()[0]
+	if (checkpoint <= lastMsg) and ((spooledLast is None) or (spooledLast <= lastMsg)):
+		return False
+	with db:
+		for table in ("ranges", "overviews", "bodies"):
+			db.execute("DELETE FROM %s WHERE alias = ?" % table, (alias,))
+	return True
+
+def fetchSpooledHeaders(spool, mailer, server, alias, wildmats, startMsg, lastMsg, metrics):
+	# Like fetchHeaders(), but only the articles that are not in the spool
+	# are asked from the server. What we fetch is added to the spool
+	gaps = getSpoolGaps(spool, alias, startMsg, lastMsg)
+	fetched = 0
+	for (first, last) in gaps:
+		if (HEADER_FILTER):
+			headers = fetchHeaders(mailer, server, first, last, wildmats)
+		else:
+			(resp, headers) = mailer.over((first, last))
+		with spool:
+			spool.executemany("INSERT OR REPLACE INTO overviews (alias, number, header) VALUES (?, ?, ?)",
+				[(alias, id, json.dumps(header)) for (id, header) in headers])
+			spool.execute("INSERT INTO ranges (alias, first, last) VALUES (?, ?, ?)", (alias, first, last))
+		fetched += last - first + 1
+	countMetric(metrics, "spoolHits", lastMsg - startMsg + 1 - fetched)
+
+	headers = []
+	for (id, header) in spool.execute("SELECT number, header FROM overviews WHERE alias = ? AND number BETWEEN ? AND ? ORDER BY number", (alias, startMsg, lastMsg)):
+		headers.append((id, json.loads(header)))
+	return headers
+
+def getSpooledBody(db, alias, id, messageId):
+	# Same as mailer.body(id), or False if the body is not spooled. A body
+	# spooled under another Message-ID is from before the group was
+	# renumbered and is not used
+	row = db.execute("SELECT messageId, body FROM bodies WHERE alias = ? AND number = ?", (alias, id)).fetchone()
+	if not (row) or (messageId and row[0] != messageId):
+		return False
+	with db:
+		db.execute("UPDATE bodies SET lastUsed = ? WHERE alias = ? AND number = ?", (time.time(), alias, id))
+	return ArticleInfo(id, row[0], zlib.decompress(row[1]).split(b"\n"))
+
+def spoolBody(db, alias, body):
+	# nntplib strips the line endings, so lines never contain a newline
+	data = zlib.compress(b"\n".join(body.lines))
+	with db:
+		db.execute("INSERT OR REPLACE INTO bodies (alias, number, messageId, body, size, lastUsed) VALUES (?, ?, ?, ?, ?, ?)",
+			(alias, body.number, body.message_id, data, len(data), time.time()))
+
+def isBodySpooled(db, alias, id):
+	return bool(db.execute("SELECT 1 FROM bodies WHERE alias = ? AND number = ?", (alias, id)).fetchone())
+
+def evictSpool(db, maxBytes, maxOverviews):
+	# Bodies go least recently used first. Overviews go oldest article
+	# first, with every range that reaches down to them
+	with db:
+		total = db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+		if (total > maxBytes):
+			evict = []
+			for (alias, number, size) in db.execute("SELECT alias, number, size FROM bodies ORDER BY lastUsed"):
+				if (total <= maxBytes):
+					break
+				evict.append((alias, number))
+				total -= size
+			db.executemany("DELETE FROM bodies WHERE alias = ? AND number = ?", evict)
+
+		for (alias, count) in db.execute("SELECT alias, COUNT(*) FROM overviews GROUP BY alias").fetchall():
+			if (count > maxOverviews):
+				cutoff = db.execute("SELECT number FROM overviews WHERE alias = ? ORDER BY number DESC LIMIT 1 OFFSET ?", (alias, maxOverviews)).fetchone()[0]
+				db.execute("DELETE FROM overviews WHERE alias = ? AND number <= ?", (alias, cutoff))
+				db.execute("DELETE FROM ranges WHERE alias = ? AND first <= ?", (alias, cutoff))
+
+def openDDTSMirror(file):
+	db = sqlite3.connect(file)
+	db.execute("CREATE TABLE IF NOT EXISTS ddts (identifier TEXT PRIMARY KEY, attribute TEXT)")
+	db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+	db.commit()
+	return db
+
+def getDDTSMirrorAge(db):
+	# Seconds since the last successful refresh, or None if never loaded
+	row = db.execute("SELECT value FROM meta WHERE key = 'lastRefresh'").fetchone()
+	if not (row):
+		return None
+	return time.time() - float(row[0])
+
+def refreshDDTSMirror(db, backend, project, product, refresh):
+	# The first refresh bulk loads every ddts of the product. Later ones
+	# only ask for records modified since the day before the last refresh
+	age = getDDTSMirrorAge(db)
+	if (age is not None) and (age < refresh):
+		return True
+
+	startTime = time.time()
+	since = False
+	if (age is not None):
+		since = time.strftime("%m/%d/%Y", time.localtime(startTime - age - 86400))
+
+	try:
+		rows = backend["listRecords"](backend, project, product, since)
+	except:
+		return False
+
+	with db:
+		db.executemany("INSERT OR REPLACE INTO ddts (identifier, attribute) VALUES (?, ?)", rows)
+		db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('lastRefresh', ?)", (str(startTime),))
+	return True
+
+def checkIfDDTSExistsMirror(db, MRList, attributeMatch):
+	# Same match as the findcr "Attribute LIKE" search.
+	# GLOB uses the same wildcard and is case sensitive, like CDETS
+	ddtsExists = {}
+	for MR in MRList:
+		row = db.execute("SELECT 1 FROM ddts WHERE attribute GLOB ? LIMIT 1", (attributeMatch % MR,)).fetchone()
+		ddtsExists[MR] = bool(row)
+	return ddtsExists
+
+def addDDTSMirror(db, MR, attribute):
+	# Records we file ourselves are added right away, so they are known
+	# before the next refresh brings in the real ddts identifier
+	with db:
+		db.execute("INSERT OR REPLACE INTO ddts (identifier, attribute) VALUES (?, ?)", ("pending-" + MR, attribute))
+
+def reconcileFiledMRs(db, filedMRs, rules):
+	# Compare the Filed MR list against the MRs of every ddts in the mirror
+	# Returns (MRs in CDETS missing from the list, MRs in the list not in CDETS)
+	cdetsMRs = set()
+	for (attribute,) in db.execute("SELECT attribute FROM ddts"):
+		MR = extractMRName(attribute, rules)
+		if (MR):
+			cdetsMRs.add(MR)
+
+	return (sorted(cdetsMRs - filedMRs), sorted(filedMRs - cdetsMRs))
+
+def buildDDTSFullText(fullText, flimit):
+	# we'll remove any blank lines from end of the files
+	fullText = fullText.rstrip()
+	return fullText[:flimit]
+
+def submitNewDDTS(template, nComments, tempDir):
+	# The template and N-comments of each MR go to temp files of their
+	# own, so MRs can be filed concurrently. Both are removed once addcr
+	# is done with them
+	files = []
+	try:
+		for text in (template, nComments):
+			(fd, file) = tempfile.mkstemp(prefix="ddts-", suffix=".txt", dir=tempDir)
+			files.append(file)
+			with os.fdopen(fd, "w") as fh:
+				fh.write(text)
+		return createNewDDTS(files[0], files[1])
+	except:
+		return False
+	finally:
+		for file in files:
+			try:
+				os.remove(file)
+			except OSError:
+				pass
+
+def createNewDDTS(templateFile, nCommentsFile):
+	
+	try:
+		ddts = runCdetsTool("addcr", ["-q", "-T", templateFile, "-n", "N-comments", "-f", nCommentsFile, "Dev-escape", "N"])
+	except:
+		return False
+
+	# addcr returns 0 on success and > 1 on error
+	if "CSC" in ddts:
+		return True
+	elif not ddts:
+		return True
+	else:
+		return False
+
+def setupThrottle(name, rate, burst, concurrency, target):
+	# Token bucket (see takeToken()) and a limit on concurrent calls of
+	# one tool, both adapted by releaseThrottle()
+	throttle = {}
+	throttle["name"] = name
+	throttle["rate"] = rate
+	throttle["burst"] = burst
+	throttle["tokens"] = burst
+	throttle["last"] = time.monotonic()
+	throttle["lock"] = threading.Lock()
+	throttle["cond"] = threading.Condition(throttle["lock"])
+	throttle["limit"] = concurrency
+	throttle["active"] = 0
+	throttle["target"] = target
+	throttle["decreased"] = 0
+	throttle["calls"] = 0
+	throttle["slow"] = 0
+	throttle["errors"] = 0
+	throttle["latency"] = 0.0
+	return throttle
+
+def takeToken(limiter):
+	# Blocks until the limiter allows one more request
+	if not (limiter["rate"]):
+		return
+	while True:
+		with limiter["lock"]:
+			now = time.monotonic()
+			limiter["tokens"] = min(limiter["burst"], limiter["tokens"] + (now - limiter["last"]) * limiter["rate"])
+			limiter["last"] = now
+			if (limiter["tokens"] >= 1):
+				limiter["tokens"] -= 1
+				return
+			wait = (1 - limiter["tokens"]) / limiter["rate"]
+		time.sleep(wait)
+
+def acquireThrottle(throttle):
+	with throttle["cond"]:
+		while (throttle["active"] >= int(throttle["limit"])):
+			throttle["cond"].wait()
+		throttle["active"] += 1
+	takeToken(throttle)
+
+def releaseThrottle(throttle, seconds, ok):
+	# AIMD: a failed or slow call halves the rate and the concurrency, once
+	# per cdetsBackoffInterval, so a burst of slow calls counts as one.
+	# A good call adds cdetsRateStep / rate to the rate, which is
+	# cdetsRateStep a second, and 1 / limit to the concurrency
+	with throttle["cond"]:
+		throttle["active"] -= 1
+		throttle["calls"] += 1
+		if (throttle["calls"] == 1):
+			throttle["latency"] = seconds
+		else:
+			throttle["latency"] = 0.8 * throttle["latency"] + 0.2 * seconds
+		slow = seconds > throttle["target"]
+		if not (ok):
+			throttle["errors"] += 1
+		elif (slow):
+			throttle["slow"] += 1
+		if (ADAPTIVE_THROTTLE):
+			if not (ok) or (slow):
+				now = time.monotonic()
+				if (now - throttle["decreased"] >= cdetsBackoffInterval):
+					throttle["decreased"] = now
+					throttle["limit"] = max(1, throttle["limit"] / 2)
+					if (throttle["rate"]):
+						throttle["rate"] = max(cdetsMinRate, throttle["rate"] / 2)
+			else:
+				throttle["limit"] = min(cdetsMaxConcurrency, throttle["limit"] + 1 / throttle["limit"])
+				if (throttle["rate"]):
+					throttle["rate"] = min(cdetsMaxRate, throttle["rate"] + cdetsRateStep / throttle["rate"])
+		throttle["cond"].notify_all()
+
+def throttledCall(throttle, function, *args, **kwargs):
+	acquireThrottle(throttle)
+	start = time.monotonic()
+	ok = False
+	try:
+		result = function(*args, **kwargs)
+		ok = True
+		return result
+	finally:
+		releaseThrottle(throttle, time.monotonic() - start, ok)
+
+def formatThrottle(throttle):
+	with throttle["lock"]:
+		if (throttle["rate"]):
+			rate = "%.1f calls/s" % throttle["rate"]
+		else:
+			rate = "no rate limit"
+		return "%s %s, %d concurrent, %d calls, %d slow, %d failed, %.2fs latency" % (throttle["name"], rate,
+			int(throttle["limit"]), throttle["calls"], throttle["slow"], throttle["errors"], throttle["latency"])
+
+# Shared by all profiles of a run, they all use the same CDETS
+cdetsThrottles = {}
+cdetsThrottles["findcr"] = setupThrottle("findcr", findcrRate, findcrBurst, cdetsConcurrency, findcrLatencyTarget)
+cdetsThrottles["addcr"] = setupThrottle("addcr", addcrRate, addcrBurst, cdetsConcurrency, addcrLatencyTarget)
+
+def fileNewDDTS(template, nComments, metrics, journal, MR):
+	# Runs on the filing pool. An exception is a failed filing of this
+	# MR only. Without the intent on disk we do not file
+	try:
+		journalSync(journal, journalAppend(journal, "intent", MR))
+	except:
+		return False
+	stageStart = time.monotonic()
+	try:
+		filed = cdets["createMany"](cdets, [(template, nComments)])[0]
+	except:
+		filed = False
+	observeStage(metrics, "addcr", time.monotonic() - stageStart)
+	if (filed):
+		try:
+			journalSync(journal, journalAppend(journal, "filed", MR))
+		except:
+			# The intent makes the next run look the MR up in CDETS
+			pass
+	return filed
+
+def reconcile(profile):
+	product = profile["Product"]
+	filedMRsFile = profile["filedMRsFile"]
+	ddtsMirrorFile = profile["ddtsMirrorFile"]
+	file_logger, console_logger = setupLogger(profile["Name"])
+
+	try:
+		db = openDDTSMirror(ddtsMirrorFile)
+		if not (refreshDDTSMirror(db, cdets, profile["Project"], product, ddtsMirrorRefresh)):
+			if (LOG):
+				file_logger.error("Error refreshing DDTS mirror %s", ddtsMirrorFile)
+			if (CONSOLE):
+				console_logger.error("Error refreshing DDTS mirror %s", ddtsMirrorFile)
+			quit()
+		(knownMRs, mrfh) = openKnownMRs(filedMRsFile, knownMRsCompactRatio)
+		(missingMRs, unknownMRs) = reconcileFiledMRs(db, knownMRs, profile["rules"])
+		db.close()
+	except Exception as e:
+		if (LOG):
+			file_logger.error("Error reconciling %s against CDETS", filedMRsFile, exc_info=True)
+		if (CONSOLE):
+			console_logger.error("Error reconciling %s against CDETS", filedMRsFile, exc_info=True)
+		quit()
+
+	# MRs that have a ddts but are not in the Filed MR list are added to it
+	with mrfh:
+		for MR in missingMRs:
+			addKnownMR(knownMRs, mrfh, MR)
+			if (LOG):
+				file_logger.info("DDTS exists for MR %s, added to %s", MR, filedMRsFile)
+			if (VERBOSE):
+				console_logger.info("DDTS exists for MR %s, added to %s", MR, filedMRsFile)
+
+	# MRs in the Filed MR list without a ddts are only reported
+	for MR in unknownMRs:
+		if (LOG):
+			file_logger.warning("MR %s is in %s but no DDTS found in Product: %s", MR, filedMRsFile, product)
+		if (CONSOLE):
+			console_logger.warning("MR %s is in %s but no DDTS found in Product: %s", MR, filedMRsFile, product)
+
+	print("%s: %d MRs added, %d MRs without DDTS" % (filedMRsFile, len(missingMRs), len(unknownMRs)))
+
+# Settings of a profile and the projectDict key each of them sets
+profileSettings = [
+	("alias", "Alias"),
+	("server", "Server"),
+	("project", "Project"),
+	("product", "Product"),
+	("version", "Version"),
+	("component", "Component"),
+	("releaseAttribute", "Attribute"),
+	("severity", "Severity"),
+	("dePriority", "dePriority"),
+	("DataClassification", "Data-classification"),
+	("DataClassificationReason", "Data-classification-reason"),
+]
+
+def buildProfile(settings, mrFormat, rules=False, name=False):
+	# A profile is the projectDict of one alias / product, plus its news
+	# server, subject rules and state files. Settings missing from the
+	# profile use the values at the top of the script of its MR format.
+	# State files and logs are named after the profile, which is the
+	# section name in a profiles file and the product otherwise
+	profile = dict(mrFormat["projectDict"])
+	for (setting, key) in profileSettings:
+		if (setting in settings):
+			profile[key] = settings[setting]
+	profile["Name"] = name or profile["Product"]
+	if (cdets["kind"] == "fake"):
+		profile["Name"] = fakeStatePrefix + profile["Name"]
+	profile["cdetsSummaryLimit"] = cdetsSummaryLimit
+	profile["cdetsNotesLimit"] = cdetsNotesLimit
+	profile["cdetsHeadlineLimit"] = cdetsHeadlineLimit
+	profile["Format"] = mrFormat
+	profile["rules"] = compileSubjectRules(rules or mrFormat["subjectRules"])
+
+	# Logfile (should persist) that contains list of all MRs already in the system
+	profile["filedMRsFile"] = profile["Name"] + "-Filed-MRs.txt"
+	# Checkpoint file (should persist) that records the last fully processed
+	# article number for each server / alias, so we only fetch new overviews
+	profile["checkpointFile"] = profile["Name"] + "-Checkpoint.txt"
+	# Journal of the filings in progress. "intent MR" is on disk before addcr
+	# runs and "filed MR" right after it filed the DDTS. Filings running at the
+	# same time share one fsync (group commit). At startup filed MRs missing
+	# from the Filed MR file are added, and MRs with an intent only are looked
+	# up in CDETS again before they are filed
+	profile["journalFile"] = profile["Name"] + "-Journal.txt"
+	profile["ddtsMirrorFile"] = profile["Name"] + "-DDTS-Mirror.db"
+	profile["spoolFile"] = profile["Name"] + "-Spool.db"
+	profile["metricsFile"] = profile["Name"] + "-Metrics.json"
+	profile["planFile"] = profile["Name"] + "-Plan.json"
+	profile["promMetricsFile"] = profile["Name"] + "-Metrics.prom"
+	return profile
+
+def getFormat(name, mrFormat):
+	# The MR format of the running script, or the one of the filer script
+	# of that format
+	if (name == mrFormat["name"]):
+		return mrFormat
+	if (name not in filerScripts):
+		print("Unknown MR format %s, known formats: %s" % (name, " ".join(sorted(filerScripts))), file=sys.stderr)
+		quit()
+	return importlib.import_module(filerScripts[name]).mrFormat
+
+def loadProfiles(file, mrFormat, rules=False):
+	# Profiles file has one section per profile, using the same names
+	# as the variables at the top of the filer script. The section name
+	# names the state files and the log of the profile.
+	# format and rules are optional, a profile uses the MR format of the
+	# running script and the --rules subject rules by default
+	# [att-core-crs1]
+	# alias = cisco.cs.att-csbh-mr
+	# product = att-core-crs1
+	# version = 5.1.x
+	# component = jb7175
+	# releaseAttribute = ATT_SIAD_Rel2
+	# format = JIRA
+	# rules = jira-rules.ini
+	config = configparser.ConfigParser(interpolation=None)
+	config.optionxform = str
+	with open(file, "r") as fh:
+		config.read_file(fh)
+
+	profiles = []
+	for section in config.sections():
+		settings = dict(config[section])
+		profileFormat = mrFormat
+		profileRules = rules
+		if ("format" in settings):
+			profileFormat = getFormat(settings["format"], mrFormat)
+			if (profileFormat is not mrFormat):
+				profileRules = False
+		if ("rules" in settings):
+			profileRules = loadSubjectRules(settings["rules"])
+		profiles.append(buildProfile(settings, profileFormat, profileRules, section))
+	return profiles
+
+def watchProfile(profile, interval):
+	# Poll the alias with GROUP, which is cheap, and only run the filer
+	# when articles past the last checkpoint have arrived
+	file_logger, console_logger = setupLogger(profile["Name"])
+	state = openProfileState(profile)
+	mailer = False
+	failures = 0
+
+	while True:
+		try:
+			if not (mailer):
+				mailer = NNTP(profile["Server"], port=nntpPort, readermode=True, timeout=nntpTimeout)
+				if (LOG):
+					file_logger.info('Connected to Server: %s, watching alias: %s', profile["Server"], profile["Alias"])
+				if (VERBOSE):
+					console_logger.info('Connected to Server: %s, watching alias: %s', profile["Server"], profile["Alias"])
+			(reply, count, firstMsg, lastMsg, name) = mailer.group(profile["Alias"])
+			if (getStartMsg(state["checkpoint"], firstMsg, lastMsg) <= lastMsg):
+				runProfile(profile, mailer, state)
+			failures = 0
+			delay = interval
+		except (Exception, SystemExit) as e:
+			# quit() in runProfile raises SystemExit, which must not stop
+			# the watch either. We drop the session and reconnect at once,
+			# servers close idle sessions. If that fails too we back off
+			failures += 1
+			if (failures == 1):
+				delay = 0
+			else:
+				delay = min(interval * (2 ** (failures - 1)), watchBackoffMax)
+			if (LOG):
+				file_logger.warning('Lost connection to alias %s (%s), retrying in %d seconds', profile["Alias"], e, delay)
+			if (CONSOLE):
+				console_logger.warning('Lost connection to alias %s (%s), retrying in %d seconds', profile["Alias"], e, delay)
+			if (mailer):
+				try:
+					mailer.quit()
+				except:
+					pass
+			mailer = False
+		time.sleep(delay)
+
+def runSharedProfile(profile, mailerPool, state=False, ingested=False):
+	# An alias read by the asyncio reader needs no connection, runProfile()
+	# takes one from mailerPool only for bodies the reader did not fetch
+	if (ingested):
+		runProfile(profile, False, state, ingested=ingested, mailerPool=mailerPool)
+		return
+	mailer = acquireMailer(mailerPool, profile["Server"])
+	broken = True
+	try:
+		runProfile(profile, mailer, state, ingested=ingested, mailerPool=mailerPool)
+		broken = False
+	finally:
+		releaseMailer(mailerPool, profile["Server"], mailer, broken)
+
+async def ingestProfiles(profiles, states):
+	# Reads the aliases of all profiles with asyncIngest() on one event
+	# loop. An alias takes one connection and bodyWorkers body readers,
+	# as many aliases of a server are read at a time as fit into
+	# maxServerConnections. Bodies without a reader are fetched later by
+	# runProfile(). Returns what asyncIngest() returned for each profile,
+	# or the exception it raised
+	bodyWorkers = max(0, min(bodyPoolSize, maxServerConnections - 1))
+	semaphores = {}
+	for profile in profiles:
+		if (profile["Server"] not in semaphores):
+			semaphores[profile["Server"]] = asyncio.Semaphore(max(1, maxServerConnections // (1 + bodyWorkers)))
+
+	async def ingest(profile, state):
+		async with semaphores[profile["Server"]]:
+			stageStart = time.monotonic()
+			result = await asyncIngest(profile["Server"], profile["Alias"], state["checkpoint"], state["knownMRs"], profile["rules"],
+				profile["Format"]["processBody"], bodyWorkers, asyncQueueSize, nntpTimeout)
+			observeStage(state["metrics"], "ingest", time.monotonic() - stageStart)
+			return result
+
+	return await asyncio.gather(*[ingest(profile, state) for (profile, state) in zip(profiles, states)], return_exceptions=True)
+
+def runProfiles(profiles, watch=False):
+	# All profiles are processed concurrently, one thread each. They share
+	# NNTP connections to the same server and keep their own state files
+	# and logs. A failing profile does not stop the others.
+	# With the asyncio reader the aliases of all profiles are read on one
+	# event loop first. In watch mode every profile keeps its own session
+	# open instead
+	mailerPool = setupMailerPool(maxServerConnections, nntpTimeout)
+	states = [False] * len(profiles)
+	ingested = [False] * len(profiles)
+	if (ASYNC_NNTP) and not (watch):
+		for (i, profile) in enumerate(profiles):
+			try:
+				states[i] = openProfileState(profile)
+			except Exception as e:
+				# runProfile() opens it again and reports the error
+				pass
+		ready = [i for i in range(len(profiles)) if states[i]]
+		results = asyncio.run(ingestProfiles([profiles[i] for i in ready], [states[i] for i in ready]))
+		for (i, result) in zip(ready, results):
+			ingested[i] = result
+	with ThreadPoolExecutor(max_workers=max(len(profiles), 1)) as executor:
+		futures = []
+		for (profile, state, result) in zip(profiles, states, ingested):
+			if (watch):
+				futures.append(executor.submit(watchProfile, profile, watch))
+			else:
+				futures.append(executor.submit(runSharedProfile, profile, mailerPool, state, result))
+	for (profile, future) in zip(profiles, futures):
+		if (future.exception()):
+			print("Error processing alias %s: %s" % (profile["Alias"], future.exception()), file=sys.stderr)
+	for state in states:
+		if (state):
+			closeProfileState(state)
+	closeMailerPool(mailerPool)
+
+def readArchive(path):
+	# Raw messages of an mbox file, a Maildir, or a news spool directory
+	# with one message per file, in archive order
+	if os.path.isfile(path):
+		archive = mailbox.mbox(path, factory=None, create=False)
+		for key in archive.iterkeys():
+			yield archive.get_bytes(key)
+	elif os.path.isdir(os.path.join(path, "cur")):
+		archive = mailbox.Maildir(path, factory=None, create=False)
+		for key in sorted(archive.iterkeys()):
+			yield archive.get_bytes(key)
+	else:
+		names = [name for name in os.listdir(path) if name.isdigit()]
+		for name in sorted(names, key=int):
+			with open(os.path.join(path, name), "rb") as fh:
+				yield fh.read()
+
+def parseArchiveMessage(id, raw):
+	# Same (header, body) the news server gives us: a header dict with
+	# the fields we use, and an ArticleInfo with the raw body lines
+	raw = raw.replace(b"\r\n", b"\n")
+	(head, sep, text) = raw.partition(b"\n\n")
+	header = {"subject": "", "from": "", "message-id": ""}
+	name = False
+	for line in head.decode("utf-8", "surrogateescape").split("\n"):
+		if line[:1] in (" ", "\t"):
+			# Folded header, continued from the line before
+			if (name):
+				header[name] += " " + line.strip()
+			continue
+		(name, sep, value) = line.partition(":")
+		name = name.strip().lower()
+		if (name in header) and (sep):
+			header[name] = value.strip()
+		else:
+			name = False
+	lines = text.split(b"\n")
+	if (lines) and not (lines[-1]):
+		lines.pop()
+	return (header, ArticleInfo(id, header["message-id"], lines))
+
+def backfillWorker(chunk, rules, processBody):
+	# Runs on the backfill pool. Returns (id, header, rtn, parsed, error) for
+	# every message of the chunk, parsed is (body, mrDict, fullMRText) for
+	# new MRs. The raw lines are not sent back, only what processBody() kept.
+	# A message we cannot read does not fail its chunk, it comes back with
+	# the error and runBackfill() logs and skips it
+	results = []
+	for (id, raw) in chunk:
+		header = {"subject": ""}
+		rtn = False
+		parsed = False
+		error = False
+		try:
+			(header, body) = parseArchiveMessage(id, raw)
+			rtn = processHeader(header, id, rules)
+			if (rtn):
+				(mrDict, fullMRText) = processBody(body)
+				parsed = (ArticleInfo(id, body.message_id, []), mrDict, fullMRText)
+		except Exception as e:
+			rtn = False
+			parsed = False
+			error = "%s: %s" % (type(e).__name__, e)
+		results.append((id, header, rtn, parsed, error))
+	return results
+
+def readArchiveChunks(paths, chunkSize):
+	# Messages of all archives numbered from 1, in chunks of chunkSize
+	chunk = []
+	id = 0
+	for path in paths:
+		for raw in readArchive(path):
+			id += 1
+			chunk.append((id, raw))
+			if (len(chunk) >= chunkSize):
+				yield chunk
+				chunk = []
+	if (chunk):
+		yield chunk
+
+def runBackfill(profile, paths):
+	# Files the MRs found in mail archives of the alias. Reading, classifying
+	# and parsing run on a process pool with a bounded number of chunks in
+	# flight, then the known MR, CDETS and filing stages run as usual
+	file_logger, console_logger = setupLogger(profile["Name"])
+	state = openProfileState(profile)
+	knownMRs = state["knownMRs"]
+	classified = []
+	parsedBodies = {}
+	bodyMRs = set()
+
+	try:
+		with ProcessPoolExecutor(max_workers=backfillWorkers) as executor:
+			pending = []
+			chunks = readArchiveChunks(paths, backfillChunkSize)
+			while True:
+				for chunk in chunks:
+					pending.append(executor.submit(backfillWorker, chunk, profile["rules"], profile["Format"]["processBody"]))
+					if (len(pending) >= 2 * backfillWorkers):
+						break
+				if not (pending):
+					break
+				# Results are collected in archive order
+				for (id, header, rtn, parsed, error) in pending.pop(0).result():
+					if (error):
+						if (LOG):
+							file_logger.warning('Skipped message %d of the archives: %s', id, error)
+						if (CONSOLE):
+							console_logger.warning('Skipped message %d of the archives: %s', id, error)
+					classified.append((id, compactHeader(header, rtn), rtn))
+					# Only the first article of an MR is filed, planRun()
+					# makes the same one canonical
+					if (rtn) and (rtn[0] not in knownMRs) and (rtn[0] not in bodyMRs):
+						bodyMRs.add(rtn[0])
+						parsedBodies[id] = parsed
+	except Exception as e:
+		if (LOG):
+			file_logger.error('Error reading archives %s', " ".join(paths), exc_info=True)
+		if (CONSOLE):
+			console_logger.error('Error reading archives %s', " ".join(paths), exc_info=True)
+		quit()
+
+	runProfile(profile, state=state, backfill=(classified, parsedBodies))
+	closeProfileState(state)
+
+def setupMetrics():
+	# Counters and stage latency histograms of a profile. Watch mode keeps
+	# them between runs, so they add up over the life of the process
+	metrics = {}
+	metrics["lock"] = threading.Lock()
+	metrics["started"] = time.time()
+	metrics["counters"] = OrderedDict()
+	for (name, promName, help) in metricsCounters:
+		metrics["counters"][name] = 0
+	metrics["stages"] = OrderedDict()
+	return metrics
+
+def countMetric(metrics, name, count=1):
+	with metrics["lock"]:
+		metrics["counters"][name] += count
+
+def observeStage(metrics, stage, seconds):
+	# Buckets are kept per bound here and made cumulative on export
+	with metrics["lock"]:
+		if (stage not in metrics["stages"]):
+			metrics["stages"][stage] = {"buckets": [0] * len(metricsBuckets), "count": 0, "sum": 0.0, "max": 0.0}
+		histogram = metrics["stages"][stage]
+		i = bisect.bisect_left(metricsBuckets, seconds)
+		if (i < len(metricsBuckets)):
+			histogram["buckets"][i] += 1
+		histogram["count"] += 1
+		histogram["sum"] += seconds
+		histogram["max"] = max(histogram["max"], seconds)
+
+def formatMetricsJSON(metrics, alias, product):
+	with metrics["lock"]:
+		stages = OrderedDict()
+		for (stage, histogram) in metrics["stages"].items():
+			buckets = OrderedDict()
+			total = 0
+			for (bound, count) in zip(metricsBuckets, histogram["buckets"]):
+				total += count
+				buckets[str(bound)] = total
+			buckets["+Inf"] = histogram["count"]
+			stages[stage] = {"count": histogram["count"], "sum": round(histogram["sum"], 6), "max": round(histogram["max"], 6), "buckets": buckets}
+		report = OrderedDict()
+		report["alias"] = alias
+		report["product"] = product
+		report["started"] = metrics["started"]
+		report["updated"] = time.time()
+		report["counters"] = OrderedDict(metrics["counters"])
+		report["stages"] = stages
+	return json.dumps(report, indent=1) + "\n"
+
+def formatMetricsProm(metrics, alias, product, metricsPrefix):
+	labels = 'alias="%s",product="%s"' % (alias, product)
+	lines = []
+	with metrics["lock"]:
+		for (name, promName, help) in metricsCounters:
+			metric = "%s_%s_total" % (metricsPrefix, promName)
+			lines.append("# HELP %s %s" % (metric, help))
+			lines.append("# TYPE %s counter" % metric)
+			lines.append("%s{%s} %d" % (metric, labels, metrics["counters"][name]))
+
+		metric = "%s_stage_seconds" % metricsPrefix
+		lines.append("# HELP %s Time spent in each stage of a run" % metric)
+		lines.append("# TYPE %s histogram" % metric)
+		for (stage, histogram) in metrics["stages"].items():
+			stageLabels = '%s,stage="%s"' % (labels, stage)
+			total = 0
+			for (bound, count) in zip(metricsBuckets, histogram["buckets"]):
+				total += count
+				lines.append('%s_bucket{%s,le="%s"} %d' % (metric, stageLabels, bound, total))
+			lines.append('%s_bucket{%s,le="+Inf"} %d' % (metric, stageLabels, histogram["count"]))
+			lines.append("%s_sum{%s} %f" % (metric, stageLabels, histogram["sum"]))
+			lines.append("%s_count{%s} %d" % (metric, stageLabels, histogram["count"]))
+
+		metric = "%s_last_run_timestamp_seconds" % metricsPrefix
+		lines.append("# HELP %s Time the metrics were last written" % metric)
+		lines.append("# TYPE %s gauge" % metric)
+		lines.append("%s{%s} %f" % (metric, labels, time.time()))
+	return "\n".join(lines) + "\n"
+
+def exportMetrics(profile, metrics, file_logger, console_logger):
+	# Written to a temp file and renamed, so collectors never read a
+	# partially written file
+	if not (METRICS):
+		return
+	try:
+		for (file, text) in ((profile["metricsFile"], formatMetricsJSON(metrics, profile["Alias"], profile["Product"])),
+				(profile["promMetricsFile"], formatMetricsProm(metrics, profile["Alias"], profile["Product"], profile["Format"]["metricsPrefix"]))):
+			tmpFile = file + ".tmp"
+			with open(tmpFile, "w") as fh:
+				fh.write(text)
+			os.replace(tmpFile, file)
+	except Exception as e:
+		if (LOG):
+			file_logger.error("Error writing metrics of alias: %s", profile["Alias"], exc_info=True)
+		if (CONSOLE):
+			console_logger.error("Error writing metrics of alias: %s", profile["Alias"], exc_info=True)
+
+def writePlanReport(profile, text, file_logger, console_logger):
+	try:
+		tmpFile = profile["planFile"] + ".tmp"
+		with open(tmpFile, "w") as fh:
+			fh.write(text)
+		os.replace(tmpFile, profile["planFile"])
+	except Exception as e:
+		if (LOG):
+			file_logger.error("Error writing plan report of alias: %s", profile["Alias"], exc_info=True)
+		if (CONSOLE):
+			console_logger.error("Error writing plan report of alias: %s", profile["Alias"], exc_info=True)
+
+def parseArgs(projectDict):
+	alias = projectDict["Alias"]
+	product = projectDict["Product"]
+	filedMRsFile = product + "-Filed-MRs.txt"
+	parser = argparse.ArgumentParser(description="File swtools DDTS for new MRs received on %s" % alias)
+	parser.add_argument("--reconcile", action="store_true",
+		help="reconcile %s against the DDTS mirror of %s and exit" % (filedMRsFile, product))
+	parser.add_argument("--import-mrs", nargs="+", metavar="FILE",
+		help="import Filed MR lists kept by older copies of this script into %s and exit" % filedMRsFile)
+	parser.add_argument("--profiles", metavar="FILE",
+		help="process every alias / product profile in FILE in one process")
+	parser.add_argument("--watch", nargs="?", type=int, const=watchInterval, metavar="SECONDS",
+		help="keep running and poll the alias every SECONDS (default %d)" % watchInterval)
+	parser.add_argument("--rules", metavar="FILE",
+		help="load the new MR subject rules from FILE")
+	parser.add_argument("--backend", choices=["cdets", "fake"],
+		help="CDETS backend to use (default %s), the fake one keeps its own %s* state files" % (cdetsBackend, fakeStatePrefix))
+	parser.add_argument("--backfill", nargs="+", metavar="PATH",
+		help="file the MRs found in mbox, Maildir or news spool archives of %s and exit" % alias)
+	return parser.parse_args()
+
+def openProfileState(profile):
+	# In-memory state of a profile that watch mode keeps between runs
+	state = {}
+	(state["knownMRs"], state["mrfh"]) = openKnownMRs(profile["filedMRsFile"], knownMRsCompactRatio)
+	state["journal"] = openJournal(profile["journalFile"], state["knownMRs"], state["mrfh"])
+	state["checkpoint"] = getCheckpoint(profile["checkpointFile"], profile["Server"], profile["Alias"])
+	state["metrics"] = setupMetrics()
+	return state
+
+def closeProfileState(state):
+	state["journal"]["fh"].close()
+	state["mrfh"].close()
+
+def closeQuietly(close, *args, **kwargs):
+	# An error closing one resource must not keep the others open
+	try:
+		close(*args, **kwargs)
+	except Exception:
+		pass
+
+runSummary = "Summary of alias %s: %d articles, %d not new MRs, %d copies, %d already filed, %d filed, %d failed"
+
+def runProfile(profile, sharedMailer=False, state=False, backfill=False, ingested=False, mailerPool=False):
+	alias = profile["Alias"]
+	server = profile["Server"]
+	project = profile["Project"]
+	product = profile["Product"]
+	projectDict = profile
+	mrFormat = profile["Format"]
+	rules = profile["rules"]
+	processBody = mrFormat["processBody"]
+	attributeMatch = mrFormat["attributeMatch"]
+	filedMRsFile = profile["filedMRsFile"]
+	checkpointFile = profile["checkpointFile"]
+	ddtsMirrorFile = profile["ddtsMirrorFile"]
+
+	file_logger, console_logger = setupLogger(profile["Name"])
+
+	# A single run loads its state and closes it again at the end,
+	# watch mode passes in the state it keeps between runs. Whatever the
+	# run opens is closed again, also when it fails or quit()s
+	ownState = not (state)
+	if (ownState):
+		state = openProfileState(profile)
+	knownMRs = state["knownMRs"]
+	mrfh = state["mrfh"]
+	journal = state["journal"]
+	checkpoint = state["checkpoint"]
+	metrics = state["metrics"]
+	countMetric(metrics, "runs")
+	runStart = time.monotonic()
+	mailer = False
+	pooledMailer = False
+	broken = True
+	spool = False
+	ddtsMirror = False
+	bodyPool = False
+	filingPool = False
+	filings = []
+
+	try:
+		# Overviews and bodies are read from the spool when we have them. The
+		# asyncio reader always reads from the server
+		spool = False
+		if (SPOOL) and not (ASYNC_NNTP) and not (backfill):
+			try:
+				spool = openSpool(profile["spoolFile"])
+			except Exception as e:
+				if (LOG):
+					file_logger.error("Error opening spool %s", profile["spoolFile"], exc_info=True)
+				if (CONSOLE):
+					console_logger.error("Error opening spool %s", profile["spoolFile"], exc_info=True)
+
+		if (backfill):
+			# 1. - 3. Messages of mail archives, classified and parsed by
+			# runBackfill(). Their ids are positions in the archives, not
+			# article numbers of the alias
+			mailer = False
+			(classified, parsedBodies) = backfill
+			firstMsg = startMsg = 1
+			lastMsg = len(classified)
+			if (LOG):
+				file_logger.info('Read %d messages of alias %s from archives', lastMsg, alias)
+			if (VERBOSE):
+				console_logger.info('Read %d messages of alias %s from archives', lastMsg, alias)
+		elif (ASYNC_NNTP):
+			# 1. - 3. Connect, fetch the new message headers and classify them on the
+			# asyncio reader. Bodies of new MRs are fetched and parsed while the
+			# overview is still streaming in
+			# runProfiles() reads the aliases of all its profiles on one
+			# event loop and passes in what it got, or the error
+			mailer = False
+			stageStart = time.monotonic()
+			try:
+				if (ingested):
+					if isinstance(ingested, BaseException):
+						raise ingested
+					(firstMsg, lastMsg, startMsg, classified, parsedBodies) = ingested
+				else:
+					(firstMsg, lastMsg, startMsg, classified, parsedBodies) = asyncio.run(asyncIngest(server, alias, checkpoint, knownMRs, rules, processBody, max(bodyPoolSize, 1), asyncQueueSize, nntpTimeout))
+					observeStage(metrics, "ingest", time.monotonic() - stageStart)
+				if (LOG):
+					file_logger.info('Successfully retrieved messages from alias %s', alias)
+				if (VERBOSE):
+					console_logger.info('Successfully retrieved messages from alias %s', alias)
+			except Exception as e:
+				if (LOG):
+					file_logger.error('Error retrieving messages for alias: %s', alias, exc_info=True)
+				if (CONSOLE):
+					console_logger.error('Error retrieving messages for alias: %s', alias, exc_info=True)
+				quit()
+		else:
+			parsedBodies = {}
+
+			# 1. Connect to mailer and retreive first & last MsgIds for mr alias
+			stageStart = time.monotonic()
+			try:
+				(mailer, firstMsg, lastMsg) = setupMailer(server, alias, product, file_logger, console_logger, sharedMailer)
+				observeStage(metrics, "connect", time.monotonic() - stageStart)
+			except Exception as e:
+				if (LOG):
+					file_logger.error('Error connecting to alias %s', alias, exc_info=True)
+				if (CONSOLE):
+					console_logger.error('Error connecting to alias %s', alias, exc_info=True)
+				quit()
+
+			# 2. Process new MRs - Get message headers for all messages after the
+			# last checkpoint (or from firstMsg on the first run) to lastMsg
+			startMsg = getStartMsg(checkpoint, firstMsg, lastMsg)
+			if (spool) and dropRenumberedSpool(spool, alias, checkpoint, lastMsg):
+				if (LOG):
+					file_logger.info('Alias %s was renumbered, dropped its spooled articles', alias)
+				if (VERBOSE):
+					console_logger.info('Alias %s was renumbered, dropped its spooled articles', alias)
+			# 3. Classify the message headers window by window as they arrive,
+			# only compact records are kept for the run. All of them are
+			# classified first, so that the CDETS lookups for every candidate
+			# MR of this run can be batched into a few queries
+			classified = []
+			if (startMsg <= lastMsg):
+				stageStart = time.monotonic()
+				classifyTime = 0
+				try:
+					for headers in streamOverviews(mailer, server, alias, rules["wildmats"], spool, startMsg, lastMsg, overviewWindow, metrics):
+						classifyStart = time.monotonic()
+						for (id, header) in headers:
+							rtn = processHeader(header, id, rules)
+							classified.append((id, compactHeader(header, rtn), rtn))
+						classifyTime += time.monotonic() - classifyStart
+					observeStage(metrics, "overview", time.monotonic() - stageStart - classifyTime)
+					observeStage(metrics, "classify", classifyTime)
+					if (LOG):
+						file_logger.info('Successfully retrieved messages from alias %s', alias)
+					if (VERBOSE):
+						console_logger.info('Successfully retrieved messages from alias %s', alias)
+				except Exception as e:
+					if (LOG):
+						file_logger.error('Error retrieving messages for alias: %s', alias, exc_info=True)
+					if (CONSOLE):
+						console_logger.error('Error retrieving messages for alias: %s', alias, exc_info=True)
+					quit()
+
+		countMetric(metrics, "articles", max(lastMsg - startMsg + 1, 0))
+
+		if (startMsg > lastMsg):
+			if (LOG):
+				file_logger.info('No new messages in alias %s since article %s', alias, checkpoint)
+			if (VERBOSE):
+				console_logger.info('No new messages in alias %s since article %s', alias, checkpoint)
+			exportMetrics(profile, metrics, file_logger, console_logger)
+			broken = False
+			return
+
+		# First article we failed to file in this run, if any.
+		# The checkpoint must not move past it, so the next run retries it
+		failedId = 0
+
+		# Per-run counts for the summary line at the end of the run. With
+		# XPAT the server only sends us the new MR articles, the others are
+		# counted from the article numbers
+		articleCount = max(lastMsg - startMsg + 1, 0)
+		newCount = 0
+		copyCount = 0
+		knownCount = 0
+		filedCount = 0
+		failedCount = 0
+
+		# Plan the run: each MR once, with its copies grouped under it.
+		# Only the MRs of the plan that are not known are looked up
+		stageStart = time.monotonic()
+		plan = planRun(classified)
+		candidateMRs = [MR for MR in plan["canonical"] if MR not in knownMRs]
+		newCount = len(plan["articles"])
+		countMetric(metrics, "newMRs", newCount)
+		observeStage(metrics, "plan", time.monotonic() - stageStart)
+
+		# The local DDTS mirror answers the lookups when enabled and fresh.
+		# Otherwise we ask CDETS with batched findcr queries
+		ddtsMirror = False
+		if (DDTS_MIRROR):
+			try:
+				ddtsMirror = openDDTSMirror(ddtsMirrorFile)
+			except Exception as e:
+				if (LOG):
+					file_logger.error("Error opening DDTS mirror %s", ddtsMirrorFile, exc_info=True)
+				if (CONSOLE):
+					console_logger.error("Error opening DDTS mirror %s", ddtsMirrorFile, exc_info=True)
+
+		if (ddtsMirror) and not (refreshDDTSMirror(ddtsMirror, cdets, project, product, ddtsMirrorRefresh)):
+			if (LOG):
+				file_logger.warning("Error refreshing DDTS mirror %s, using findcr for this run", ddtsMirrorFile)
+			if (CONSOLE):
+				console_logger.warning("Error refreshing DDTS mirror %s, using findcr for this run", ddtsMirrorFile)
+			ddtsMirror.close()
+			ddtsMirror = False
+
+		if (ddtsMirror):
+			ddtsExists = checkIfDDTSExistsMirror(ddtsMirror, candidateMRs, attributeMatch)
+			# An interrupted run may have filed the MRs of its open intents,
+			# the mirror does not know them yet. A failed lookup stays failed
+			recheckMRs = [MR for MR in candidateMRs if MR in journal["pending"]]
+			if (recheckMRs):
+				if (LOG):
+					file_logger.info("%d MRs of an interrupted run are looked up in CDETS again", len(recheckMRs))
+				if (VERBOSE):
+					console_logger.info("%d MRs of an interrupted run are looked up in CDETS again", len(recheckMRs))
+				for MR in recheckMRs:
+					ddtsExists[MR] = None
+				ddtsExists.update(cdets["existsMany"](cdets, recheckMRs, project, product, attributeMatch))
+				countMetric(metrics, "cdetsLookups", len(recheckMRs))
+		else:
+			stageStart = time.monotonic()
+			ddtsExists = cdets["existsMany"](cdets, candidateMRs, project, product, attributeMatch)
+			observeStage(metrics, "lookup", time.monotonic() - stageStart)
+			countMetric(metrics, "cdetsLookups", len(candidateMRs))
+
+		if (PLAN_REPORT):
+			writePlanReport(profile, formatPlanReport(plan, alias, product, knownMRs, ddtsExists), file_logger, console_logger)
+
+		# New DDTS are created on the filing pool while the loop below goes on
+		# reading bodies, as many at a time as the addcr throttle allows.
+		# Results are collected in article order at the end
+		filingPool = ThreadPoolExecutor(max_workers=cdetsMaxConcurrency)
+
+		# Start fetching the bodies of the MRs we will file on the pool
+		# connections. The loop below still files them in article order
+		bodyPool = False
+		bodyFutures = {}
+		if (bodyPoolSize) and (mailer):
+			newIds = []
+			for (MR, id) in plan["canonical"].items():
+				if (MR not in knownMRs) and not (ddtsExists.get(MR)):
+					if (spool) and isBodySpooled(spool, alias, id):
+						continue
+					newIds.append(id)
+			if (newIds):
+				bodyPool = setupBodyPool(server, alias, bodyPoolSize, nntpTimeout, mailerPool)
+				bodyFutures = prefetchBodies(bodyPool, newIds)
+
+		# 3.1 Process message header, one message at a time
+		# Check if this is a new MR from parsing the header['subject']
+		# If new MR, process the message body
+		for (id, header, rtn) in classified:
+
+			# These are debug functions that will help us debug any issues
+			# related to reading the message headers
+			if (DEBUG):
+				debugDumpHeader(id, header)
+				if (id >= counter):
+					quit()
+
+			if (id in plan["articles"]):
+				# 4. Process message body & extract MR fields - mrDict
+				# extract MR summary - we need to write this to MRSummaryFile
+				# extract Full MR Text - we need to write this to MRTextFile
+				MR = plan["articles"][id]
+				comp = rtn[1]
+				subject = rtn[2]
+				# Copies of an earlier article of the run are grouped with it
+				# by the plan, only the canonical article goes on
+				if (plan["canonical"][MR] != id):
+					countMetric(metrics, "copies")
+					copyCount += 1
+					if (LOG):
+						file_logger.debug("%s: Copy of article %s of MR %s", id, plan["canonical"][MR], MR)
+					if (VERBOSE):
+						console_logger.debug("%s: Copy of article %s of MR %s", id, plan["canonical"][MR], MR)
+					continue
+
+				# 4.1 We are here because message subject shows its a NEW MR
+				# Lets check if the MR is in filedMRsFile
+				# if its in filedMRsFile, lets check if DDTS exists
+				# if DDTS does not exist, lets open a DDTS
+				# If DDTS exists, lets move to the next message
+				if (MR in knownMRs):
+					countMetric(metrics, "knownHits")
+					knownCount += 1
+					if (LOG):
+						file_logger.debug("%s: MR %s already exists in %s", id, MR, filedMRsFile)
+					if (VERBOSE):
+						console_logger.debug("%s: MR %s already exists in %s", id, MR, filedMRsFile)
+					# 4.2 If we are here, the MR is in the filedMRsFile
+					# we go to the next message
+					continue
+
+				ddtsFound = ddtsExists.get(MR)
+				if (ddtsFound is None):
+					# The lookup failed, we retry the MR on the next run
+					countMetric(metrics, "failures")
+					if not (failedId):
+						failedId = id
+					if (LOG):
+						file_logger.error("%s: Error looking up DDTS for MR %s in Project: %s", id, MR, product)
+					if (CONSOLE):
+						console_logger.error("%s: Error looking up DDTS for MR %s in Project: %s", id, MR, product)
+				elif (ddtsFound):
+					countMetric(metrics, "ddtsFound")
+					# 4.3 If we are here, the MR is not in the filedMRsFile
+					# But DDTS exists; we need to update the filedMRsFile
+					addKnownMR(knownMRs, mrfh, MR)
+					if (LOG):
+						file_logger.info("%s: DDTS already exists for %s in Project: %s", id, MR, product)
+						file_logger.info("%s: MR %s added to %s", id, MR, filedMRsFile)
+					if (VERBOSE):
+						console_logger.info("%s: DDTS already exists for %s in Project: %s", id, MR, product)
+						console_logger.info("%s: MR %s added to %s", id, MR, filedMRsFile)
+				else:
+				 	# 4.4 If we are here, we have found a new MR in the subject field
+				 	# The MR is not in the filedMRsFile & No DDTS exists for this MR
+				 	# We need to process the message body and extract MR data
+				 	# We need to open a new DDTS and
+				 	# We need to then add the MR to the filedMRsFile
+					if (LOG): 
+						file_logger.info("%s: No DDTS found for MR %s in Project: %s", id, MR, product)
+						file_logger.info("%s: New MR %s, Subject: %s...", id, MR, header['subject'][:cdetsHeadlineLimit])
+					if (VERBOSE): 
+						console_logger.info("%s: No DDTS found for MR %s in Project: %s", id, MR, product)
+						console_logger.info("%s: New MR %s, Subject: %s...", id, MR, header['subject'][:cdetsHeadlineLimit])
+
+				
+					if (id in parsedBodies):
+						# Fetched and parsed by the asyncio pipeline or the
+						# backfill pool
+						(body, mrDict, fullMRText) = parsedBodies.pop(id)
+					elif (backfill):
+						# Backfill ids are positions in the archives, not article
+						# numbers of the alias, the news server is never asked
+						countMetric(metrics, "failures")
+						failedCount += 1
+						if not (failedId):
+							failedId = id
+						if (LOG):
+							file_logger.error("%s: No parsed body of MR %s in the archives", id, MR)
+						if (CONSOLE):
+							console_logger.error("%s: No parsed body of MR %s in the archives", id, MR)
+						continue
+					else:
+						# The asyncio pipeline has no blocking connection, we
+						# only open one for bodies it could not fetch
+						# Retrieve message body & parse MR data
+						stageStart = time.monotonic()
+						body = False
+						if (spool):
+							body = getSpooledBody(spool, alias, id, header.get("message-id"))
+						if (body):
+							countMetric(metrics, "spoolHits")
+						else:
+							if not (mailer) and (mailerPool):
+								# A connection of the server's budget, handed
+								# back to mailerPool at the end of the run
+								pooledMailer = acquireMailer(mailerPool, server)
+								mailer = setupMailer(server, alias, product, file_logger, console_logger, pooledMailer)[0]
+							elif not (mailer):
+								mailer = setupMailer(server, alias, product, file_logger, console_logger, sharedMailer)[0]
+							(resp, body) = getBody(mailer, bodyFutures, id)
+							if (spool):
+								spoolBody(spool, alias, body)
+						observeStage(metrics, "body", time.monotonic() - stageStart)
+						stageStart = time.monotonic()
+						(mrDict, fullMRText) = processBody(body)
+						observeStage(metrics, "processBody", time.monotonic() - stageStart)
+
+					# These are debug functions that will help us debug any issues
+					# related to reading the message headers
+					if (DEBUG):
+						debugDumpBody(id, body)
+						if (id >= counter):
+							quit()
+
+					template = mrFormat["buildDDTSTemplate"](projectDict, mrDict, MR)
+					if (template):
+						if (LOG):
+							file_logger.info("%s: Successfully created DDTS Template for MR: %s", id, MR)
+						if (VERBOSE):
+							console_logger.info("%s: Successfully created DDTS Template for MR: %s", id, MR)
+						nComments = buildDDTSFullText(fullMRText, cdetsNotesLimit)
+
+						# We'll create the DDTS now
+						future = filingPool.submit(fileNewDDTS, template, nComments, metrics, journal, MR)
+						countMetric(metrics, "filings")
+						filings.append((id, MR, mrFormat["buildDDTSAttribute"](projectDict, mrDict, MR), future))
+					else:
+						if (LOG):
+							file_logger.error("%s: Error creating swtools record for MR: %s in Project: %s", id, MR, product)
+						if (CONSOLE):
+							console_logger.error("%s: Error creating swtools record for MR: %s in Project: %s", id, MR, product)
+			else:
+				if (LOG):
+					file_logger.debug("%s: Not a new MR, Subject: %s...", id, header['subject'][:cdetsHeadlineLimit])
+				if (VERBOSE):
+					console_logger.debug("%s: Not a new MR, Subject: %s...", id, header['subject'][:cdetsHeadlineLimit])
+
+		# 5. Record the DDTS filed on the pool in article order. A failed
+		# filing only holds back the checkpoint, the MRs after it are recorded
+		while (filings):
+			(id, MR, attribute, future) = filings.pop(0)
+			if (future.result()):
+				countMetric(metrics, "filed")
+				filedCount += 1
+				# Add the MR to the Filed MR List
+				addKnownMR(knownMRs, mrfh, MR)
+				if (ddtsMirror):
+					addDDTSMirror(ddtsMirror, MR, attribute)
+				if (LOG):
+					file_logger.info("%s: Successfully created swtools record for MR: %s", id, MR)
+					file_logger.info("%s: MR %s added to %s", id, MR, filedMRsFile)
+				if (VERBOSE):
+					console_logger.info("%s: Successfully created swtools record for MR: %s", id, MR)
+					console_logger.info("%s: MR %s added to %s", id, MR, filedMRsFile)
+			else:
+				countMetric(metrics, "failures")
+				failedCount += 1
+				if not (failedId):
+					failedId = id
+				if (LOG):
+					file_logger.error("%s: Error creating swtools record for MR: %s", id, MR)
+				if (CONSOLE):
+					console_logger.error("%s: Error creating swtools record for MR: %s", id, MR)
+		filingPool.shutdown()
+		for tool in ("findcr", "addcr"):
+			if (LOG):
+				file_logger.info("CDETS throttle: %s", formatThrottle(cdetsThrottles[tool]))
+			if (VERBOSE):
+				console_logger.info("CDETS throttle: %s", formatThrottle(cdetsThrottles[tool]))
+
+		# The Filed MR file is on disk now, the journal only keeps the intents
+		# that are still open
+		try:
+			checkpointJournal(journal, knownMRs, mrfh)
+		except Exception as e:
+			if (LOG):
+				file_logger.error("Error writing journal %s", profile["journalFile"], exc_info=True)
+			if (CONSOLE):
+				console_logger.error("Error writing journal %s", profile["journalFile"], exc_info=True)
+
+		# A backfill does not move the checkpoint of the alias. MRs that failed
+		# are retried by running the backfill again, filed MRs are known by then
+		if (backfill):
+			if (failedId):
+				if (LOG):
+					file_logger.warning("Not every MR of the archives was filed, run the backfill again to retry the failed ones")
+				if (CONSOLE):
+					console_logger.warning("Not every MR of the archives was filed, run the backfill again to retry the failed ones")
+		else:
+			# Every article up to lastMsg has been processed, except the ones
+			# after a failed filing. Messages without MR data in the body are not
+			# retried, they would fail the same way on every run
+			if (failedId):
+				lastProcessed = failedId - 1
+			else:
+				lastProcessed = lastMsg
+			try:
+				saveCheckpoint(checkpointFile, server, alias, lastProcessed)
+				state["checkpoint"] = lastProcessed
+				if (LOG):
+					file_logger.info("Checkpoint for alias %s saved at article %s", alias, lastProcessed)
+			except Exception as e:
+				if (LOG):
+					file_logger.error("Error saving checkpoint for alias: %s", alias, exc_info=True)
+				if (CONSOLE):
+					console_logger.error("Error saving checkpoint for alias: %s", alias, exc_info=True)
+
+		observeStage(metrics, "run", time.monotonic() - runStart)
+		exportMetrics(profile, metrics, file_logger, console_logger)
+
+		if (LOG):
+			file_logger.info("Successfully processed new messages from alias: %s", alias)
+			file_logger.info(runSummary, alias, articleCount, articleCount - newCount, copyCount, knownCount, filedCount, failedCount)
+		if (VERBOSE):
+			console_logger.info("Successfully processed new messages from alias: %s", alias)
+			console_logger.info(runSummary, alias, articleCount, articleCount - newCount, copyCount, knownCount, filedCount, failedCount)
+		broken = False
+	finally:
+		# Filings that have not started are dropped, their MRs are
+		# retried by the next run. The DDTS the pool did file before the
+		# run failed are journaled, they are recorded like in 5. so that
+		# watch mode and the mirror know them too
+		if (filingPool):
+			closeQuietly(filingPool.shutdown, cancel_futures=True)
+			for (id, MR, attribute, future) in filings:
+				if (future.cancelled()) or (future.exception()) or not (future.result()):
+					continue
+				closeQuietly(addKnownMR, knownMRs, mrfh, MR)
+				if (ddtsMirror):
+					closeQuietly(addDDTSMirror, ddtsMirror, MR, attribute)
+				if (LOG):
+					file_logger.info("%s: MR %s filed before the run failed, added to %s", id, MR, filedMRsFile)
+				if (VERBOSE):
+					console_logger.info("%s: MR %s filed before the run failed, added to %s", id, MR, filedMRsFile)
+		if (bodyPool):
+			closeQuietly(closeBodyPool, bodyPool)
+		if (ddtsMirror):
+			closeQuietly(ddtsMirror.close)
+		if (spool):
+			closeQuietly(evictSpool, spool, spoolMaxBytes, spoolMaxOverviews)
+			closeQuietly(spool.close)
+		if (pooledMailer):
+			closeQuietly(releaseMailer, mailerPool, server, pooledMailer, broken)
+		elif (mailer) and (mailer is not sharedMailer):
+			closeQuietly(mailer.quit)
+		if (ownState):
+			closeQuietly(closeProfileState, state)
+
+def main(mrFormat):
+	runProfile(buildProfile({}, mrFormat))
+
+def runCommandLine(mrFormat):
+	global cdets
+	args = parseArgs(mrFormat["projectDict"])
+	rules = False
+	if (args.rules):
+		rules = loadSubjectRules(args.rules)
+	if (args.backend):
+		cdets = setupCdetsBackend(args.backend)
+	if (args.import_mrs):
+		profile = buildProfile({}, mrFormat, rules)
+		count = importKnownMRs(profile["filedMRsFile"], args.import_mrs)
+		print("%s: %d MRs imported" % (profile["filedMRsFile"], count))
+	elif (args.reconcile):
+		reconcile(buildProfile({}, mrFormat, rules))
+	elif (args.backfill):
+		runBackfill(buildProfile({}, mrFormat, rules), args.backfill)
+	elif (args.profiles):
+		runProfiles(loadProfiles(args.profiles, mrFormat, rules), args.watch)
+	elif (args.watch):
+		watchProfile(buildProfile({}, mrFormat, rules), args.watch)
+	else:
+		runProfile(buildProfile({}, mrFormat, rules))
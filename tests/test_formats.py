@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+# Tests of the MR formats of jirafiler.py and Scrubber.py: subject rules
+# and body parsing
+#
+# python3 -m pytest -q tests
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from nntplib import ArticleInfo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import mrfiler
+import jirafiler
+import Scrubber
+
+# processBody() of jirafiler.py and Scrubber.py before the bodies were
+# parsed as a stream. They decode every line and keep the whole text,
+# the streaming parsers must give the same DDTS
+
+def baselineJiraProcessBody(body):
+	fullMRText = ""
+	mrDict = OrderedDict()
+	mrDict = {
+		'MR': '',
+		'Abstract': '',
+		'Summary': ''}
+
+	lines = list(map(lambda line: line.decode(), body.lines))
+
+	for line in lines:
+		line = str(line)
+
+		if line.startswith("AT&T Proprietary (Internal Use Only)"):
+			break
+
+		if line.endswith('='):
+			line = re.sub('=$', '', line)
+			if '=3D' in line:
+				line = re.sub('=3D', '=', line)
+			fullMRText += line
+		elif '=3D' in line:
+			line = re.sub('=3D', '=', line)
+			fullMRText += line + "\n"
+		else:
+			fullMRText += line + "\n"
+
+		if line.startswith(">"):
+		  line = line[1:]
+
+		line = line.lstrip()
+
+		if re.search(':', line):
+			if line.startswith("Summary: "):
+				match = re.split(': ',line,1)
+				if (len(match) > 1):
+					mrDict['Summary'] = match[1].lstrip()
+					mrDict['Abstract'] = match[1].lstrip()
+			elif line.startswith("Key: "):
+				match = re.split(': ',line)
+				if (len(match) > 1):
+					mrDict['MR'] = match[1].lstrip()
+	return (mrDict, fullMRText)
+
+def baselineScrubberProcessBody(body):
+	fullMRText = ""
+	mrDict = OrderedDict()
+	mrDict = {
+		'MR': '',
+		'Abstract': '',
+		'Severity': '',
+		'Summary': ''}
+
+	lines = list(map(lambda line: line.decode(), body.lines))
+
+	for line in lines:
+		fullMRText += line + "\n"
+
+		if re.search(':', line):
+			if line.startswith("MR:"):
+				match = re.split(':',line)
+				if (len(match) > 1):
+					mrDict['MR'] = match[1].lstrip()
+			elif line.startswith("Abstract:"):
+				match = re.split(':',line)
+				if (len(match) > 1):
+					mrDict['Abstract'] = match[1].lstrip()
+			elif line.startswith("Severity:"):
+				match = re.split(':',line)
+				if (len(match) > 1):
+					mrDict['Severity'] = match[1].lstrip()
+			elif line.startswith("Summary:"):
+				match = re.split(':',line)
+				if (len(match) > 1):
+					mrDict['Summary'] = match[1].lstrip()
+	return (mrDict, fullMRText)
+
+# Bodies in the quoted-printable form the mailer hands them over.
+# Only "=3D" escapes are used, the baseline parsers decode no others
+jiraBody = [
+	b"Key: MDSIADCISC-16",
+	b"Summary: 5501 reloads when the interface =",
+	b"flaps",
+	b"=3D=3D=3D=3D=3D=3D=3D=3D=3D=3D=3D=3D=3D=3D",
+	b"Description: a =3D b when the line is long enough to be wrapped by the m=",
+	b"ailer, and the wrapped part =3D=",
+	b"=3D continues here",
+	b"",
+	b"> Summary: quoted summary of an earlier comment",
+	b">Key: MDSIADCISC-17",
+	b"   ",
+	b"Comment history that is long enough to go past the N-comments limit",
+	b"Summary: the last summary wins",
+	b"",
+	b"",
+	b"AT&T Proprietary (Internal Use Only)",
+	b"Key: MDSIADCISC-99",
+	b"Summary: text after the disclaimer is never used",
+]
+
+scrubberBody = [
+	b"MR: ATTip12345",
+	b"Abstract: 5501 reloads when the interface flaps",
+	b"Severity: 2",
+	b"Summary: first summary line is soft broken =",
+	b"=3D=3D=3D=3D=3D=3D",
+	b"> Summary: quoted summary",
+	b"",
+	b"Comment history that is long enough to go past the N-comments limit",
+	b"Summary:the last summary wins",
+	b"   ",
+	b"AT&T Proprietary (Internal Use Only)",
+	b"Severity: 4",
+]
+
+class ProcessBodyTest(unittest.TestCase):
+	# The streaming parsers against the baseline ones, for every
+	# N-comments limit up to past the end of the body
+
+	def compare(self, processBody, baselineProcessBody, lines):
+		body = ArticleInfo(1, "<1@test>", lines)
+		(baselineDict, baselineText) = baselineProcessBody(body)
+		for limit in range(0, len(baselineText) + 2):
+			(mrDict, fullText) = processBody(body, limit)
+			self.assertEqual(mrDict, baselineDict, "limit %d" % limit)
+			self.assertEqual(mrfiler.buildDDTSFullText(fullText, limit), mrfiler.buildDDTSFullText(baselineText, limit), "limit %d" % limit)
+		# The default limit is the N-comments limit of CDETS
+		(mrDict, fullText) = processBody(body)
+		self.assertEqual(mrfiler.buildDDTSFullText(fullText, mrfiler.cdetsNotesLimit), mrfiler.buildDDTSFullText(baselineText, mrfiler.cdetsNotesLimit))
+
+	def testJira(self):
+		self.compare(jirafiler.processBody, baselineJiraProcessBody, jiraBody)
+
+	def testJiraEmptyBody(self):
+		self.compare(jirafiler.processBody, baselineJiraProcessBody, [])
+
+	def testJiraOnlyDisclaimer(self):
+		self.compare(jirafiler.processBody, baselineJiraProcessBody, jiraBody[-3:])
+
+	def testScrubber(self):
+		self.compare(Scrubber.processBody, baselineScrubberProcessBody, scrubberBody)
+
+	def compareLongBody(self, processBody, baselineProcessBody, lines):
+		# A long stack trace between the MR fields and the last summary
+		lines = lines[:3] + [b"Line %d of a stack trace" % i for i in range(2000)] + lines[3:]
+		body = ArticleInfo(1, "<1@test>", lines)
+		(baselineDict, baselineText) = baselineProcessBody(body)
+		(mrDict, fullText) = processBody(body)
+		self.assertEqual(mrDict, baselineDict)
+		self.assertLess(len(fullText), len(baselineText))
+		self.assertEqual(mrfiler.buildDDTSFullText(fullText, mrfiler.cdetsNotesLimit), mrfiler.buildDDTSFullText(baselineText, mrfiler.cdetsNotesLimit))
+
+	def testJiraLongBody(self):
+		self.compareLongBody(jirafiler.processBody, baselineJiraProcessBody, jiraBody)
+
+	def testScrubberLongBody(self):
+		self.compareLongBody(Scrubber.processBody, baselineScrubberProcessBody, scrubberBody)
+
+class SubjectRulesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.jira = mrfiler.compileSubjectRules(jirafiler.subjectRules)
+		self.attip = mrfiler.compileSubjectRules(Scrubber.subjectRules)
+
+	def header(self, subject):
+		return {"subject": subject, "from": 'jdoe@example.com ("jdoe@example.com")'}
+
+	def testJiraSubjects(self):
+		# Subjects as JIRA sends them and as they come back forwarded
+		for subject in ("[JIRA] Created: (MDSIADCISC-16) 5501: Link down",
+				"[JIRA] created: (MDSIADCISC-16) 5501: Link down",
+				"[JIRA] created (MDSIADCISC-16) 5501: Link down",
+				"[JIRA] Created (MDSIADCISC-16) 5501: Link down",
+				"Fwd: [JIRA] Created: (MDSIADCISC-16) 5501: Link down",
+				"=?utf-8?q?=5BJIRA=5D_Created=3A_=28MDSIADCISC-16=29_5501=3A_Link_down?="):
+			self.assertEqual(mrfiler.processHeader(self.header(subject), 1, self.jira), ("MDSIADCISC-16", "jdoe", mrfiler.decodeHeader(subject)))
+		self.assertEqual(mrfiler.classifySubject("[JIRA] Created: (CC-7) Card reload", self.jira), (True, "CC-7", "JIRA"))
+
+	def testJiraSubjectsThatAreNotNew(self):
+		for subject in ("[JIRA] Updated: (MDSIADCISC-16) 5501: Link down",
+				"[JIRA] Commented: (MDSIADCISC-16) 5501: Link down",
+				"Re: weekly sync"):
+			self.assertEqual(mrfiler.classifySubject(subject, self.jira), (False, False, False))
+			self.assertFalse(mrfiler.processHeader(self.header(subject), 1, self.jira))
+
+	def testNewSubjectWithoutKey(self):
+		subject = "[JIRA] Created: (OTHER-16) 5501: Link down"
+		self.assertEqual(mrfiler.classifySubject(subject, self.jira), (True, False, "JIRA"))
+		self.assertFalse(mrfiler.processHeader(self.header(subject), 1, self.jira))
+
+	def testATTipSubjects(self):
+		subject = "ATTip12345:core-crs:New:2: BGP flap"
+		self.assertEqual(mrfiler.processHeader(self.header(subject), 1, self.attip), ("ATTip12345", "jdoe", subject))
+		self.assertEqual(mrfiler.classifySubject("ATTip12345:core-crs:Closed:2: BGP flap", self.attip), (False, False, False))
+		self.assertEqual(mrfiler.classifySubject("ATTip1234:core-crs:New:2: BGP flap", self.attip), (False, False, False))
+		self.assertEqual(mrfiler.classifySubject("Fwd: ATTip12345:core-crs:New:2: BGP flap", self.attip), (False, False, False))
+
+	def testBothFormats(self):
+		rules = mrfiler.compileSubjectRules(jirafiler.subjectRules + Scrubber.subjectRules)
+		self.assertEqual(mrfiler.classifySubject("ATTip12345:core-crs:New:2: BGP flap", rules), (True, "ATTip12345", "ATTip"))
+		self.assertEqual(mrfiler.classifySubject("[JIRA] Created: (CC-7) Card reload", rules), (True, "CC-7", "JIRA"))
+		self.assertEqual(rules["wildmats"], [jirafiler.subjectRules[0][3], Scrubber.subjectRules[0][3]])
+
+class LoadSubjectRulesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.dir)
+
+	def load(self, text):
+		path = os.path.join(self.dir, "rules.ini")
+		with open(path, "w") as fh:
+			fh.write(text)
+		return mrfiler.loadSubjectRules(path)
+
+	def testRulesFile(self):
+		rules = self.load("[JIRA]\n"
+			"new = \\[JIRA\\] [cC]reated:? \\(\\w+-\\d+\\)\n"
+			"key = MDSIADCISC-\\d+\n"
+			"      CC-\\d+\n"
+			"xpat = *JIRA]?[cC]reated*\n"
+			"[ATTip]\n"
+			"new = ^ATTip\\d{5}:[\\w|\\w\\-]+:New:\\d{1}:\n"
+			"key = ^ATTip\\d{5}\n")
+		self.assertEqual(rules, [tuple(jirafiler.subjectRules[0]), ("ATTip",) + tuple(Scrubber.subjectRules[0][1:3]) + ("",)])
+
+	def testKeyPatternsWithSpacesAndBlankLines(self):
+		rules = self.load("[JIRA]\n"
+			"new = \\[JIRA\\] [cC]reated\n"
+			"key =\n"
+			"  MDSIADCISC-\\d+\n"
+			"\n"
+			"  Case \\d+\n")
+		self.assertEqual(rules[0][2], ["MDSIADCISC-\\d+", "Case \\d+"])
+		compiled = mrfiler.compileSubjectRules(rules)
+		self.assertEqual(mrfiler.classifySubject("[JIRA] Created: Case 42", compiled), (True, "Case 42", "JIRA"))
+
+if __name__ == "__main__":
+	unittest.main()
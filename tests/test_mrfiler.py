@@ -0,0 +1,929 @@
+# -*- coding: utf-8 -*-
+
+# Unit tests of the filer engine
+#
+# python3 -m pytest -q tests
+
+import io
+import os
+import asyncio
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import mrfiler
+from nntplib import NNTPDataError
+from nntplib import NNTPTemporaryError
+from nntplib import ArticleInfo
+
+# Subject rules of jirafiler.py
+jiraRules = mrfiler.compileSubjectRules([
+	("JIRA", "\\[JIRA\\] [cC]reated:? \\(\\w+-\\d+\\)", ["MDSIADCISC-\\d+", "CC-\\d+"], "*JIRA]?[cC]reated*"),
+])
+
+class StateFileTest(unittest.TestCase):
+	# Each test works in a temp directory of its own
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix="mrfiler-test-")
+
+	def tearDown(self):
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def path(self, name):
+		return os.path.join(self.dir, name)
+
+	def write(self, name, text):
+		with open(self.path(name), "w") as fh:
+			fh.write(text)
+
+	def read(self, name):
+		with open(self.path(name), "r") as fh:
+			return fh.read()
+
+class JournalTest(StateFileTest):
+
+	def openJournal(self, text=None):
+		if (text is not None):
+			self.write("Journal.txt", text)
+		(self.knownMRs, self.mrfh) = mrfiler.openKnownMRs(self.path("Filed-MRs.txt"), mrfiler.knownMRsCompactRatio)
+		self.journal = mrfiler.openJournal(self.path("Journal.txt"), self.knownMRs, self.mrfh)
+		self.addCleanup(self.mrfh.close)
+		self.addCleanup(lambda: self.journal["fh"].close())
+		return self.journal
+
+	def testNoJournal(self):
+		journal = self.openJournal()
+		self.assertEqual(journal["open"], set())
+		self.assertEqual(journal["pending"], set())
+		self.assertEqual(self.read("Journal.txt"), "")
+
+	def testReplayPairsIntentsWithFilings(self):
+		journal = self.openJournal("intent MR-1\nfiled MR-1\nintent MR-2\nintent MR-3\nfiled MR-3\nfiled MR-4\n")
+		# Filed MRs are added to the Filed MR file, with or without an intent
+		self.assertEqual(self.knownMRs, {"MR-1", "MR-3", "MR-4"})
+		self.assertEqual(self.read("Filed-MRs.txt"), "MR-1\nMR-3\nMR-4\n")
+		# An intent without a filing is pending a CDETS lookup
+		self.assertEqual(journal["pending"], {"MR-2"})
+		self.assertEqual(self.read("Journal.txt"), "intent MR-2\n")
+
+	def testReplayIgnoresTornLastLine(self):
+		# A crash in the middle of a write leaves a line without a newline
+		journal = self.openJournal("intent MR-1\nfiled MR-1\nintent MR-2\nfil")
+		self.assertEqual(self.knownMRs, {"MR-1"})
+		self.assertEqual(journal["pending"], {"MR-2"})
+
+		journal = self.openJournal("intent MR-1\nfiled MR-1\nintent MR-2\nfiled MR-2")
+		self.assertNotIn("MR-2", self.knownMRs)
+		self.assertEqual(journal["pending"], {"MR-2"})
+
+	def testReplaySkipsKnownMRs(self):
+		self.write("Filed-MRs.txt", "MR-1\n")
+		self.openJournal("intent MR-1\nfiled MR-1\n")
+		self.assertEqual(self.read("Filed-MRs.txt"), "MR-1\n")
+
+	def testReplayDropsIntentsOfKnownMRs(self):
+		# Filed by a run that died after the Filed MR file was written
+		self.write("Filed-MRs.txt", "MR-1\n")
+		journal = self.openJournal("intent MR-1\nintent MR-2\n")
+		self.assertEqual(journal["pending"], {"MR-2"})
+		self.assertEqual(self.read("Journal.txt"), "intent MR-2\n")
+
+	def testAppendAndCheckpoint(self):
+		journal = self.openJournal()
+		mrfiler.journalSync(journal, mrfiler.journalAppend(journal, "intent", "MR-1"))
+		mrfiler.journalSync(journal, mrfiler.journalAppend(journal, "intent", "MR-2"))
+		mrfiler.journalSync(journal, mrfiler.journalAppend(journal, "filed", "MR-1"))
+		self.assertEqual(self.read("Journal.txt"), "intent MR-1\nintent MR-2\nfiled MR-1\n")
+		self.assertEqual(journal["open"], {"MR-2"})
+
+		mrfiler.addKnownMR(self.knownMRs, self.mrfh, "MR-1")
+		mrfiler.checkpointJournal(journal, self.knownMRs, self.mrfh)
+		self.assertEqual(self.read("Journal.txt"), "intent MR-2\n")
+		self.assertFalse(os.path.exists(self.path("Journal.txt.tmp")))
+		self.assertEqual(journal["synced"], journal["written"])
+
+		# The journal is open for appending again after the rewrite
+		mrfiler.journalSync(journal, mrfiler.journalAppend(journal, "filed", "MR-2"))
+		self.assertEqual(self.read("Journal.txt"), "intent MR-2\nfiled MR-2\n")
+
+	def testCheckpointAfterCrashReplays(self):
+		journal = self.openJournal()
+		mrfiler.journalSync(journal, mrfiler.journalAppend(journal, "intent", "MR-1"))
+		mrfiler.journalSync(journal, mrfiler.journalAppend(journal, "filed", "MR-1"))
+		mrfiler.journalSync(journal, mrfiler.journalAppend(journal, "intent", "MR-2"))
+		# The process dies here, the next start replays the journal
+		journal["fh"].close()
+		self.mrfh.close()
+		journal = self.openJournal()
+		self.assertEqual(self.knownMRs, {"MR-1"})
+		self.assertEqual(journal["pending"], {"MR-2"})
+
+class GroupCommitTest(JournalTest):
+
+	def testSyncedEntriesDoNotFsyncAgain(self):
+		journal = self.openJournal()
+		with mock.patch("mrfiler.os.fsync") as fsync:
+			seq1 = mrfiler.journalAppend(journal, "intent", "MR-1")
+			seq2 = mrfiler.journalAppend(journal, "intent", "MR-2")
+			mrfiler.journalSync(journal, seq2)
+			mrfiler.journalSync(journal, seq1)
+		self.assertEqual(fsync.call_count, 1)
+		self.assertEqual(journal["synced"], seq2)
+
+	def testWaitingWritersShareOneFsync(self):
+		journal = self.openJournal()
+		inFsync = threading.Event()
+		release = threading.Event()
+		fsyncs = []
+
+		def slowFsync(fd):
+			fsyncs.append(journal["written"])
+			if (len(fsyncs) == 1):
+				inFsync.set()
+				release.wait(5)
+
+		with mock.patch("mrfiler.os.fsync", side_effect=slowFsync):
+			seq1 = mrfiler.journalAppend(journal, "intent", "MR-1")
+			leader = threading.Thread(target=mrfiler.journalSync, args=(journal, seq1))
+			leader.start()
+			self.assertTrue(inFsync.wait(5))
+
+			# Written while the first fsync runs, these wait for it and
+			# are then covered by a single fsync
+			seqs = [mrfiler.journalAppend(journal, "intent", "MR-%d" % i) for i in (2, 3, 4)]
+			followers = [threading.Thread(target=mrfiler.journalSync, args=(journal, seq)) for seq in seqs]
+			for follower in followers:
+				follower.start()
+			time.sleep(0.1)
+			self.assertEqual(journal["synced"], 0)
+			release.set()
+			for thread in [leader] + followers:
+				thread.join(5)
+				self.assertFalse(thread.is_alive())
+
+		self.assertEqual(len(fsyncs), 2)
+		self.assertEqual(journal["synced"], seqs[-1])
+		self.assertFalse(journal["syncing"])
+
+	def testFailedFsyncIsRetried(self):
+		journal = self.openJournal()
+		seq = mrfiler.journalAppend(journal, "intent", "MR-1")
+		with mock.patch("mrfiler.os.fsync", side_effect=OSError("disk full")):
+			self.assertRaises(OSError, mrfiler.journalSync, journal, seq)
+		self.assertEqual(journal["synced"], 0)
+		self.assertFalse(journal["syncing"])
+
+		with mock.patch("mrfiler.os.fsync") as fsync:
+			mrfiler.journalSync(journal, seq)
+		self.assertEqual(fsync.call_count, 1)
+		self.assertEqual(journal["synced"], seq)
+
+class CheckpointTest(StateFileTest):
+
+	def testStartMsg(self):
+		# First run, every retained article
+		self.assertEqual(mrfiler.getStartMsg(0, 100, 200), 100)
+		# The articles after the checkpoint
+		self.assertEqual(mrfiler.getStartMsg(150, 100, 200), 151)
+		# Nothing new
+		self.assertEqual(mrfiler.getStartMsg(200, 100, 200), 201)
+		# Articles after the checkpoint expired
+		self.assertEqual(mrfiler.getStartMsg(50, 100, 200), 100)
+		# Group renumbered, the checkpoint is past the end of the group
+		self.assertEqual(mrfiler.getStartMsg(5000, 1, 200), 1)
+		# Empty group after a reset (RFC 3977: last = first - 1)
+		self.assertEqual(mrfiler.getStartMsg(5000, 1, 0), 1)
+
+	def testMissingCheckpointFile(self):
+		self.assertEqual(mrfiler.getCheckpoint(self.path("Checkpoint.txt"), "news", "alias"), 0)
+
+	def testSaveKeepsOtherAliases(self):
+		file = self.path("Checkpoint.txt")
+		mrfiler.saveCheckpoint(file, "news", "alias1", 10)
+		mrfiler.saveCheckpoint(file, "news", "alias2", 20)
+		mrfiler.saveCheckpoint(file, "other", "alias1", 30)
+		mrfiler.saveCheckpoint(file, "news", "alias1", 11)
+		self.assertEqual(mrfiler.getCheckpoint(file, "news", "alias1"), 11)
+		self.assertEqual(mrfiler.getCheckpoint(file, "news", "alias2"), 20)
+		self.assertEqual(mrfiler.getCheckpoint(file, "other", "alias1"), 30)
+		self.assertEqual(self.read("Checkpoint.txt"), "news alias1 11\nnews alias2 20\nother alias1 30\n")
+		self.assertFalse(os.path.exists(file + ".tmp"))
+
+	def testMalformedLinesAreIgnored(self):
+		self.write("Checkpoint.txt", "news alias1\nnews alias2 x12\nnews alias3 12 extra\n\nnews alias4 7\n")
+		file = self.path("Checkpoint.txt")
+		for alias in ("alias1", "alias2", "alias3"):
+			self.assertEqual(mrfiler.getCheckpoint(file, "news", alias), 0)
+		self.assertEqual(mrfiler.getCheckpoint(file, "news", "alias4"), 7)
+
+	def testFailedSaveKeepsOldCheckpoint(self):
+		file = self.path("Checkpoint.txt")
+		mrfiler.saveCheckpoint(file, "news", "alias", 10)
+		with mock.patch("mrfiler.os.fsync", side_effect=OSError("disk full")):
+			self.assertRaises(OSError, mrfiler.saveCheckpoint, file, "news", "alias", 20)
+		self.assertEqual(mrfiler.getCheckpoint(file, "news", "alias"), 10)
+
+class KnownMRsTest(StateFileTest):
+
+	def openKnownMRs(self, text=None, compactRatio=mrfiler.knownMRsCompactRatio):
+		if (text is not None):
+			self.write("Filed-MRs.txt", text)
+		(knownMRs, mrfh) = mrfiler.openKnownMRs(self.path("Filed-MRs.txt"), compactRatio)
+		self.addCleanup(mrfh.close)
+		return (knownMRs, mrfh)
+
+	def testNoIndex(self):
+		(knownMRs, mrfh) = self.openKnownMRs()
+		self.assertEqual(knownMRs, set())
+		self.assertEqual(self.read("Filed-MRs.txt"), "")
+
+	def testAddedMRsAreFlushed(self):
+		(knownMRs, mrfh) = self.openKnownMRs("MDSIADCISC-1\n")
+		mrfiler.addKnownMR(knownMRs, mrfh, "MDSIADCISC-2")
+		self.assertEqual(knownMRs, set(["MDSIADCISC-1", "MDSIADCISC-2"]))
+		self.assertEqual(self.read("Filed-MRs.txt"), "MDSIADCISC-1\nMDSIADCISC-2\n")
+
+	def testFewDuplicatesAreKept(self):
+		text = "".join("MDSIADCISC-%d\n" % i for i in range(8)) + "MDSIADCISC-1\n\n"
+		(knownMRs, mrfh) = self.openKnownMRs(text)
+		self.assertEqual(len(knownMRs), 8)
+		self.assertEqual(self.read("Filed-MRs.txt"), text)
+
+	def testManyDuplicatesAreCompacted(self):
+		(knownMRs, mrfh) = self.openKnownMRs("MDSIADCISC-2\n  MDSIADCISC-1 \nMDSIADCISC-2\n\n\nMDSIADCISC-1\n")
+		self.assertEqual(knownMRs, set(["MDSIADCISC-1", "MDSIADCISC-2"]))
+		self.assertEqual(self.read("Filed-MRs.txt"), "MDSIADCISC-1\nMDSIADCISC-2\n")
+		self.assertFalse(os.path.exists(self.path("Filed-MRs.txt.tmp")))
+		# The compacted index is still appended to
+		mrfiler.addKnownMR(knownMRs, mrfh, "MDSIADCISC-3")
+		self.assertEqual(self.read("Filed-MRs.txt"), "MDSIADCISC-1\nMDSIADCISC-2\nMDSIADCISC-3\n")
+
+	def testFailedCompactionKeepsTheIndex(self):
+		self.write("Filed-MRs.txt", "MDSIADCISC-1\nMDSIADCISC-1\n")
+		with mock.patch("mrfiler.os.fsync", side_effect=OSError("disk full")):
+			self.assertRaises(OSError, mrfiler.compactKnownMRs, self.path("Filed-MRs.txt"), set(["MDSIADCISC-1"]))
+		self.assertEqual(self.read("Filed-MRs.txt"), "MDSIADCISC-1\nMDSIADCISC-1\n")
+
+	def testImport(self):
+		self.write("Filed-MRs.txt", "MDSIADCISC-1\nMDSIADCISC-1\n")
+		self.write("old1.txt", "MDSIADCISC-2\n\nMDSIADCISC-1\n")
+		self.write("old2.txt", " MDSIADCISC-3 \nMDSIADCISC-2\n")
+		count = mrfiler.importKnownMRs(self.path("Filed-MRs.txt"), [self.path("old1.txt"), self.path("old2.txt")])
+		self.assertEqual(count, 2)
+		self.assertEqual(self.read("Filed-MRs.txt"), "MDSIADCISC-1\nMDSIADCISC-2\nMDSIADCISC-3\n")
+		# Importing the same lists again adds nothing
+		self.assertEqual(mrfiler.importKnownMRs(self.path("Filed-MRs.txt"), [self.path("old1.txt")]), 0)
+
+	def testImportIntoNewIndex(self):
+		self.write("old.txt", "MDSIADCISC-1\n")
+		self.assertEqual(mrfiler.importKnownMRs(self.path("Filed-MRs.txt"), [self.path("old.txt")]), 1)
+		self.assertEqual(self.read("Filed-MRs.txt"), "MDSIADCISC-1\n")
+
+class MirrorTest(StateFileTest):
+
+	def setUp(self):
+		StateFileTest.setUp(self)
+		self.db = mrfiler.openDDTSMirror(self.path("DDTS-Mirror.db"))
+		self.addCleanup(self.db.close)
+		self.queries = []
+
+	def findcr(self, output):
+		# Stands in for the CDETS tools, records the findcr queries
+		def runCdetsTool(tool, args):
+			self.queries.append(args[-1])
+			if isinstance(output, Exception):
+				raise output
+			return output
+		return mock.patch("mrfiler.runCdetsTool", runCdetsTool)
+
+	def refresh(self, output, refresh=900):
+		with self.findcr(output):
+			return mrfiler.refreshDDTSMirror(self.db, mrfiler.setupCdetsBackend("cdets"), "CSC.swtools", "att-core-crs1", refresh)
+
+	def testFirstRefreshLoadsTheProduct(self):
+		self.assertTrue(self.refresh("CSCab00001 MDSIADCISC-1  ATT_SIAD_Rel2\nCSCab00002 MDSIADCISC-16  ATT_SIAD_Rel2\n\nbroken\n"))
+		self.assertEqual(len(self.queries), 1)
+		self.assertIn("Product = 'att-core-crs1'", self.queries[0])
+		self.assertNotIn("Last-mod-on", self.queries[0])
+		self.assertEqual(self.db.execute("SELECT COUNT(*) FROM ddts").fetchone()[0], 2)
+		self.assertLess(mrfiler.getDDTSMirrorAge(self.db), 60)
+
+	def testFreshMirrorIsNotRefreshed(self):
+		self.refresh("CSCab00001 MDSIADCISC-1  ATT_SIAD_Rel2\n")
+		self.assertTrue(self.refresh(""))
+		self.assertEqual(len(self.queries), 1)
+
+	def testStaleMirrorOnlyAsksForModifiedRecords(self):
+		self.refresh("CSCab00001 MDSIADCISC-1  ATT_SIAD_Rel2\n")
+		self.assertTrue(self.refresh("CSCab00001 MDSIADCISC-2  ATT_SIAD_Rel2\n", refresh=0))
+		self.assertIn("Last-mod-on >= '", self.queries[1])
+		# A modified record replaces the one we had
+		self.assertEqual(mrfiler.checkIfDDTSExistsMirror(self.db, ["MDSIADCISC-1", "MDSIADCISC-2"], "*%s *"),
+			{"MDSIADCISC-1": False, "MDSIADCISC-2": True})
+
+	def testFailedRefresh(self):
+		self.assertFalse(self.refresh(OSError("findcr failed")))
+		self.assertIsNone(mrfiler.getDDTSMirrorAge(self.db))
+
+	def testLookupsMatchLikeFindcr(self):
+		self.refresh("CSCab00001 MDSIADCISC-16  ATT_SIAD_Rel2\nCSCab00002 ATTip12345 ATT_Rel1\n")
+		# The space after the MR keeps MDSIADCISC-1 from matching MDSIADCISC-16
+		self.assertEqual(mrfiler.checkIfDDTSExistsMirror(self.db, ["MDSIADCISC-1", "MDSIADCISC-16", "mdsiadcisc-16"], "*%s *"),
+			{"MDSIADCISC-1": False, "MDSIADCISC-16": True, "mdsiadcisc-16": False})
+		self.assertEqual(mrfiler.checkIfDDTSExistsMirror(self.db, ["ATTip12345", "ATTip1234"], "*%s*"),
+			{"ATTip12345": True, "ATTip1234": True})
+
+	def testFiledRecordsAreKnownBeforeTheNextRefresh(self):
+		mrfiler.addDDTSMirror(self.db, "MDSIADCISC-7", "MDSIADCISC-7  ATT_SIAD_Rel2")
+		self.assertEqual(mrfiler.checkIfDDTSExistsMirror(self.db, ["MDSIADCISC-7"], "*%s *"), {"MDSIADCISC-7": True})
+
+	def testReconcile(self):
+		self.refresh("CSCab00001 MDSIADCISC-1  ATT_SIAD_Rel2\nCSCab00002 MDSIADCISC-2  ATT_SIAD_Rel2\nCSCab00003 no MR here\n")
+		(missingMRs, unknownMRs) = mrfiler.reconcileFiledMRs(self.db, set(["MDSIADCISC-2", "MDSIADCISC-3"]), jiraRules)
+		self.assertEqual(missingMRs, ["MDSIADCISC-1"])
+		self.assertEqual(unknownMRs, ["MDSIADCISC-3"])
+
+class SpoolTest(StateFileTest):
+
+	def setUp(self):
+		StateFileTest.setUp(self)
+		self.spool = mrfiler.openSpool(self.path("Spool.db"))
+		self.addCleanup(self.spool.close)
+		self.metrics = mrfiler.setupMetrics()
+		self.mailer = mock.Mock()
+		self.mailer.over.side_effect = lambda articles: ("224 Overview", [(id, {"subject": "old %d" % id}) for id in range(articles[0], articles[1] + 1)])
+
+	def fetch(self, alias, startMsg, lastMsg):
+		with mock.patch("mrfiler.HEADER_FILTER", 0):
+			return mrfiler.fetchSpooledHeaders(self.spool, self.mailer, "server", alias, [], startMsg, lastMsg, self.metrics)
+
+	def testGaps(self):
+		self.fetch("alias", 10, 20)
+		self.assertEqual(mrfiler.getSpoolGaps(self.spool, "alias", 5, 25), [(5, 9), (21, 25)])
+		self.assertEqual(mrfiler.getSpoolGaps(self.spool, "alias", 12, 18), [])
+		self.assertEqual(mrfiler.getSpoolGaps(self.spool, "other", 12, 18), [(12, 18)])
+
+	def testSpooledOverviewsAreServed(self):
+		self.fetch("alias", 1, 20)
+		self.mailer.over.reset_mock()
+		self.assertEqual(len(self.fetch("alias", 5, 10)), 6)
+		self.mailer.over.assert_not_called()
+
+	def testRenumberedGroupDropsSpool(self):
+		# Checkpoint 20, the group now ends at article 5
+		self.fetch("alias", 1, 20)
+		self.fetch("other", 1, 20)
+		self.assertTrue(mrfiler.dropRenumberedSpool(self.spool, "alias", 20, 5))
+		self.assertEqual(mrfiler.getSpoolGaps(self.spool, "alias", 1, 5), [(1, 5)])
+		self.assertEqual(mrfiler.getSpoolGaps(self.spool, "other", 1, 5), [])
+		self.mailer.over.side_effect = lambda articles: ("224 Overview", [(id, {"subject": "new %d" % id}) for id in range(articles[0], articles[1] + 1)])
+		self.assertEqual(self.fetch("alias", 1, 5)[0][1]["subject"], "new 1")
+
+	def testSpoolPastTheGroupIsDropped(self):
+		# A checkpoint that missed the renumbering, the spool reaches past
+		# the end of the group
+		self.fetch("alias", 1, 20)
+		self.assertTrue(mrfiler.dropRenumberedSpool(self.spool, "alias", 3, 10))
+		self.assertEqual(mrfiler.getSpoolGaps(self.spool, "alias", 1, 10), [(1, 10)])
+
+	def testSpoolIsKept(self):
+		self.fetch("alias", 1, 20)
+		self.assertFalse(mrfiler.dropRenumberedSpool(self.spool, "alias", 20, 30))
+		self.assertFalse(mrfiler.dropRenumberedSpool(self.spool, "alias", 0, 20))
+		self.assertEqual(mrfiler.getSpoolGaps(self.spool, "alias", 1, 20), [])
+
+class FakeConnection:
+	# Stands in for the socket file of an nntplib connection: what we
+	# write is kept, replies are read from a canned byte string
+
+	def __init__(self, replies):
+		self.file = self
+		self.sock = mock.Mock()
+		self.sent = io.BytesIO()
+		self.replies = io.BytesIO(replies)
+
+	def write(self, data):
+		self.sent.write(data)
+
+	def flush(self):
+		pass
+
+	def readline(self):
+		return self.replies.readline()
+
+class PipelineBodiesTest(unittest.TestCase):
+
+	def testMixedReplies(self):
+		replies = (b"222 1 <1@test> body\r\nKey: MR-1\r\n..dot stuffed\r\n\r\n.\r\n"
+			b"423 No article with that number\r\n"
+			b"222 3 <3@test> body\r\nKey: MR-3\r\n.\r\n"
+			b"430 No such article\r\n")
+		mailer = FakeConnection(replies)
+		bodies = mrfiler.pipelineBodies(mailer, [1, 2, 3, 4])
+		self.assertEqual(mailer.sent.getvalue(), b"BODY 1\r\nBODY 2\r\nBODY 3\r\nBODY 4\r\n")
+		self.assertEqual(sorted(bodies), [1, 3])
+		(resp, body) = bodies[1]
+		self.assertTrue(resp.startswith("222 1"))
+		self.assertEqual(body.number, 1)
+		self.assertEqual(body.message_id, "<1@test>")
+		self.assertEqual(body.lines, [b"Key: MR-1", b".dot stuffed", b""])
+		self.assertEqual(bodies[3][1].lines, [b"Key: MR-3"])
+		self.assertEqual(mailer.replies.read(), b"")
+
+	def testReplyForAnotherArticle(self):
+		mailer = FakeConnection(b"222 2 <2@test> body\r\n.\r\n")
+		self.assertRaises(NNTPDataError, mrfiler.pipelineBodies, mailer, [1, 2])
+
+	def testReplyToAnotherCommand(self):
+		mailer = FakeConnection(b"211 10 1 10 alias\r\n")
+		self.assertRaises(NNTPDataError, mrfiler.pipelineBodies, mailer, [1])
+
+	def testConnectionClosed(self):
+		mailer = FakeConnection(b"222 1 <1@test> body\r\nKey: MR-1\r\n")
+		self.assertRaises(EOFError, mrfiler.pipelineBodies, mailer, [1, 2])
+
+	def testBrokenPipeliningFallsBackToSerial(self):
+		# The server answers the pipelined commands out of order, the
+		# window is fetched again one body at a time on a new connection
+		server = "pipeline-test"
+		bodyPool = mrfiler.setupBodyPool(server, "alias", 1, 1)
+		self.addCleanup(mrfiler.serverPipelineBroken.discard, server)
+		self.addCleanup(bodyPool["executor"].shutdown)
+		broken = FakeConnection(b"222 2 <2@test> body\r\n.\r\n")
+		bodyPool["local"].mailer = broken
+		bodyPool["connections"].append(broken)
+
+		serial = mock.Mock()
+		def body(id):
+			if (id == 2):
+				raise NNTPTemporaryError("423 No article with that number")
+			return ("222 %d <%d@test> body" % (id, id), mrfiler.ArticleInfo(id, "<%d@test>" % id, [b"Key: MR-%d" % id]))
+		serial.body.side_effect = body
+		with mock.patch("mrfiler.NNTP", return_value=serial):
+			bodies = mrfiler.fetchBodies(bodyPool, [1, 2, 3])
+
+		self.assertIn(server, mrfiler.serverPipelineBroken)
+		broken.sock.close.assert_called_once_with()
+		self.assertEqual(bodyPool["connections"], [serial])
+		self.assertEqual(sorted(bodies), [1, 3])
+		self.assertEqual(bodies[3][1].lines, [b"Key: MR-3"])
+
+class MailerPoolTest(unittest.TestCase):
+	# Body pool connections of a multi-profile run come out of the
+	# server's connection budget
+
+	def setUp(self):
+		patcher = mock.patch("mrfiler.NNTP", side_effect=lambda *args, **kwargs: mock.Mock())
+		self.NNTP = patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def testBodyConnectionsComeOutOfTheBudget(self):
+		mailerPool = mrfiler.setupMailerPool(2, 1)
+		mrfiler.acquireMailer(mailerPool, "server")
+		bodyPool = mrfiler.setupBodyPool("server", "alias", 2, 1, mailerPool)
+		mailer = mrfiler.getPoolMailer(bodyPool)
+		mailer.group.assert_called_once_with("alias")
+		errors = []
+		def otherWorker():
+			try:
+				mrfiler.getPoolMailer(bodyPool)
+			except OSError as e:
+				errors.append(e)
+		worker = threading.Thread(target=otherWorker)
+		worker.start()
+		worker.join()
+		self.assertEqual(len(errors), 1)
+		self.assertFalse(mrfiler.acquireMailer(mailerPool, "server", wait=False))
+		self.assertEqual(self.NNTP.call_count, 2)
+		# Closing the body pool hands its connection back to the budget
+		mrfiler.closeBodyPool(bodyPool)
+		mailer.quit.assert_not_called()
+		self.assertIs(mrfiler.acquireMailer(mailerPool, "server", wait=False), mailer)
+
+	def testBodiesFallBackToTheMainConnection(self):
+		mailerPool = mrfiler.setupMailerPool(1, 1)
+		main = mrfiler.acquireMailer(mailerPool, "server")
+		main.body.return_value = ("222 1 <1@test> body", "body")
+		bodyPool = mrfiler.setupBodyPool("server", "alias", 2, 1, mailerPool)
+		bodyFutures = mrfiler.prefetchBodies(bodyPool, [1, 2])
+		self.assertEqual(mrfiler.getBody(main, bodyFutures, 1), ("222 1 <1@test> body", "body"))
+		main.body.assert_called_once_with(1)
+		mrfiler.closeBodyPool(bodyPool)
+		self.assertEqual(self.NNTP.call_count, 1)
+
+	def testBrokenBodyConnectionIsClosed(self):
+		mailerPool = mrfiler.setupMailerPool(1, 1)
+		bodyPool = mrfiler.setupBodyPool("server", "alias", 1, 1, mailerPool)
+		mailer = mrfiler.getPoolMailer(bodyPool)
+		mrfiler.dropPoolMailer(bodyPool)
+		mailer.sock.close.assert_called_once_with()
+		self.assertIsNot(mrfiler.acquireMailer(mailerPool, "server", wait=False), mailer)
+
+class ThrottleTest(unittest.TestCase):
+	# The clock is ours, calls are timed by the seconds we pass in
+
+	def setUp(self):
+		self.now = 1000.0
+		patcher = mock.patch("mrfiler.time.monotonic", lambda: self.now)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.throttle = mrfiler.setupThrottle("findcr", 4, 4, 4, 1.0)
+
+	def call(self, seconds, ok=True):
+		self.throttle["active"] += 1
+		mrfiler.releaseThrottle(self.throttle, seconds, ok)
+
+	def testSlowCallHalves(self):
+		self.call(2.0)
+		self.assertEqual((self.throttle["rate"], self.throttle["limit"]), (2, 2))
+		self.assertEqual((self.throttle["slow"], self.throttle["errors"]), (1, 0))
+
+	def testFailedCallHalves(self):
+		self.call(0.1, ok=False)
+		self.assertEqual((self.throttle["rate"], self.throttle["limit"]), (2, 2))
+		self.assertEqual((self.throttle["slow"], self.throttle["errors"]), (0, 1))
+
+	def testHalvedOncePerBackoffInterval(self):
+		self.call(2.0)
+		self.call(2.0, ok=False)
+		self.now += mrfiler.cdetsBackoffInterval - 0.1
+		self.call(2.0)
+		self.assertEqual((self.throttle["rate"], self.throttle["limit"]), (2, 2))
+		self.now += 0.1
+		self.call(2.0)
+		self.assertEqual((self.throttle["rate"], self.throttle["limit"]), (1, 1))
+		self.assertEqual(self.throttle["calls"], 4)
+
+	def testAdditiveIncrease(self):
+		self.call(0.5)
+		self.assertEqual(self.throttle["limit"], 4.25)
+		self.assertEqual(self.throttle["rate"], 4 + mrfiler.cdetsRateStep / 4)
+		# The concurrency grows by about one for every limit good calls
+		for i in range(4):
+			self.call(0.5)
+		self.assertEqual(int(self.throttle["limit"]), 5)
+
+	def testBounds(self):
+		for i in range(20):
+			self.call(2.0)
+			self.now += mrfiler.cdetsBackoffInterval
+		self.assertEqual(self.throttle["limit"], 1)
+		self.assertEqual(self.throttle["rate"], mrfiler.cdetsMinRate)
+		for i in range(10000):
+			self.call(0.5)
+		self.assertEqual(self.throttle["limit"], mrfiler.cdetsMaxConcurrency)
+		self.assertEqual(self.throttle["rate"], mrfiler.cdetsMaxRate)
+
+	def testNoRateLimit(self):
+		self.throttle = mrfiler.setupThrottle("addcr", 0, 4, 4, 1.0)
+		self.call(2.0)
+		self.call(0.5)
+		self.assertEqual(self.throttle["rate"], 0)
+
+	def testFixedThrottle(self):
+		with mock.patch("mrfiler.ADAPTIVE_THROTTLE", 0):
+			self.call(2.0)
+			self.call(0.1, ok=False)
+			self.call(0.5)
+		self.assertEqual((self.throttle["rate"], self.throttle["limit"]), (4, 4))
+		self.assertEqual((self.throttle["calls"], self.throttle["slow"], self.throttle["errors"]), (3, 1, 1))
+
+	def testThrottledCallCountsFailures(self):
+		self.assertRaises(OSError, mrfiler.throttledCall, self.throttle, mock.Mock(side_effect=OSError("findcr failed")))
+		self.assertEqual(mrfiler.throttledCall(self.throttle, lambda x: x + 1, 1), 2)
+		self.assertEqual((self.throttle["calls"], self.throttle["errors"], self.throttle["active"]), (2, 1, 0))
+
+class FetchHeadersTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = "headers-test"
+		self.addCleanup(mrfiler.serverHeaderCommands.pop, self.server, None)
+		self.commands = []
+		self.transferred = 0
+		self.matches = ["12 [JIRA] Created: (MR-12) x", "15 =?utf-8?q?=5BJIRA=5D_Created=3A_=28MR-15=29?="]
+		self.mailer = mock.Mock()
+		self.mailer.getcapabilities.return_value = {"HDR": []}
+		self.mailer._longcmdstring.side_effect = self.reply
+
+	def reply(self, command):
+		self.commands.append(command)
+		words = command.split()
+		if (words[0] == "XPAT"):
+			return ("221 Headers follow", self.matches)
+		(first, sep, last) = words[2].partition("-")
+		values = {"From": "user%d@example.com", "Message-ID": "<%d@test>"}
+		lines = ["%d %s" % (id, values[words[1]].replace("%d", str(id))) for id in range(int(first), int(last or first) + 1)]
+		self.transferred += len(lines)
+		return ("225 Headers follow", lines)
+
+	def testXPATAsksForEncodedWords(self):
+		mrfiler.fetchHeaders(self.mailer, self.server, 10, 20, ["*JIRA]?[cC]reated*"])
+		self.assertEqual(self.commands[0], "XPAT Subject 10-20 *JIRA]?[cC]reated* " + mrfiler.encodedWildmat)
+
+	def testMatchesAreCompletedWithOneHDRPerField(self):
+		headers = mrfiler.fetchHeaders(self.mailer, self.server, 10, 20, ["*JIRA]?[cC]reated*"])
+		self.assertEqual(self.commands[1:], ["HDR From 12-15", "HDR Message-ID 12-15"])
+		self.mailer.over.assert_not_called()
+		self.assertEqual([id for (id, header) in headers], [12, 15])
+		self.assertEqual(headers[1][1]["message-id"], "<15@test>")
+		self.assertEqual(headers[1][1]["from"], "user15@example.com")
+
+	def testOnlyTheMatchesAreTransferred(self):
+		# Sparse matches over a large window are read run by run, not
+		# over the range from the first match to the last
+		self.matches = ["%d [JIRA] Created: (MR-%d) x" % (id, id) for id in (100, 102, 5000, 9990)]
+		headers = mrfiler.fetchHeaders(self.mailer, self.server, 1, 10000, ["*JIRA]?[cC]reated*"])
+		self.assertEqual(self.commands[1:], ["HDR From 100-102", "HDR Message-ID 100-102", "HDR From 5000", "HDR Message-ID 5000", "HDR From 9990", "HDR Message-ID 9990"])
+		self.assertEqual(self.transferred, 2 * 5)
+		self.assertEqual([header["from"] for (id, header) in headers], ["user100@example.com", "user102@example.com", "user5000@example.com", "user9990@example.com"])
+
+	def testMatchRanges(self):
+		gap = mrfiler.headerRangeGap
+		self.assertEqual(mrfiler.getMatchRanges([]), [])
+		self.assertEqual(mrfiler.getMatchRanges([7]), ["7"])
+		self.assertEqual(mrfiler.getMatchRanges([7, 8, 9]), ["7-9"])
+		self.assertEqual(mrfiler.getMatchRanges([7, 8 + gap]), ["7-%d" % (8 + gap)])
+		self.assertEqual(mrfiler.getMatchRanges([7, 9 + gap]), ["7", str(9 + gap)])
+
+	def testNoMatches(self):
+		self.mailer._longcmdstring.side_effect = lambda command: ("221 Headers follow", [])
+		self.assertEqual(mrfiler.fetchHeaders(self.mailer, self.server, 10, 20, ["*JIRA]?[cC]reated*"]), [])
+
+class PlanRunTest(unittest.TestCase):
+
+	def article(self, id, MR):
+		if (MR is None):
+			return (id, {"message-id": "<%d@test>" % id}, False)
+		return (id, {"message-id": "<%d@test>" % id}, (MR, "user", "[JIRA] Created: (%s)" % MR))
+
+	def testEachMRIsItsOwnGroup(self):
+		plan = mrfiler.planRun([
+			self.article(1, "MDSIADCISC-1"),
+			self.article(2, "MDSIADCISC-2")])
+		self.assertEqual(list(plan["canonical"].items()), [("MDSIADCISC-1", 1), ("MDSIADCISC-2", 2)])
+		self.assertEqual(plan["copies"], {"MDSIADCISC-1": [], "MDSIADCISC-2": []})
+
+	def testCopiesOfAnMR(self):
+		plan = mrfiler.planRun([
+			self.article(1, None),
+			self.article(2, "MDSIADCISC-1"),
+			self.article(3, "MDSIADCISC-1"),
+			self.article(4, "MDSIADCISC-1")])
+		self.assertEqual(list(plan["canonical"].items()), [("MDSIADCISC-1", 2)])
+		self.assertEqual(plan["copies"]["MDSIADCISC-1"], [3, 4])
+		self.assertEqual(plan["articles"], {2: "MDSIADCISC-1", 3: "MDSIADCISC-1", 4: "MDSIADCISC-1"})
+
+class BackfillWorkerTest(unittest.TestCase):
+
+	def message(self, MR):
+		return b"Subject: [JIRA] Created: (%s) x\nMessage-ID: <%s@test>\n\nKey: %s\n" % (MR, MR, MR)
+
+	def testBrokenMessageIsSkipped(self):
+		rules = mrfiler.compileSubjectRules([("JIRA", "\\[JIRA\\] Created: \\(\\w+-\\d+\\)", ["MR-\\d+"], "")])
+		def processBody(body):
+			if (body.lines[0] == b"Key: MR-2"):
+				raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+			return ({"MR": body.lines[0][5:].decode()}, "")
+		results = mrfiler.backfillWorker([(1, self.message(b"MR-1")), (2, self.message(b"MR-2")), (3, self.message(b"MR-3"))], rules, processBody)
+		self.assertEqual([id for (id, header, rtn, parsed, error) in results], [1, 2, 3])
+		self.assertEqual(results[0][2][0], "MR-1")
+		self.assertEqual(results[0][3][1], {"MR": "MR-1"})
+		self.assertFalse(results[1][2])
+		self.assertIn("UnicodeDecodeError", results[1][4])
+		self.assertEqual(results[2][3][1], {"MR": "MR-3"})
+		self.assertFalse(results[2][4])
+
+class FindcrBatchTest(unittest.TestCase):
+
+	def testChunksRunConcurrently(self):
+		lock = threading.Lock()
+		calls = {"active": 0, "peak": 0}
+		def findcr(tool, args):
+			with lock:
+				calls["active"] += 1
+				calls["peak"] = max(calls["peak"], calls["active"])
+			time.sleep(0.05)
+			with lock:
+				calls["active"] -= 1
+			if ("MR-5" in args[-1]):
+				raise OSError("findcr failed")
+			return "MR-1  ATT_Rel\nMR-7  ATT_Rel\n"
+		MRList = ["MR-%d" % i for i in range(1, 9)]
+		with mock.patch("mrfiler.runCdetsTool", side_effect=findcr):
+			ddtsExists = mrfiler.checkIfDDTSExistsBatch(MRList, "CSC.swtools", "product", "*%s *", 2)
+		self.assertGreater(calls["peak"], 1)
+		# The chunk of MR-5 and MR-6 failed and is left out
+		self.assertEqual(ddtsExists, {"MR-1": True, "MR-2": False, "MR-3": False, "MR-4": False, "MR-7": True, "MR-8": False})
+
+class ProfilesTest(StateFileTest):
+
+	def setUp(self):
+		StateFileTest.setUp(self)
+		self.mrFormat = mrfiler.setupFormat("TEST", {"Alias": "alias", "Server": "server", "Project": "CSC.swtools", "Product": "product"},
+			[("TEST", "New: MR-\\d+", ["MR-\\d+"], "New: *")], False, False, False, "*%s *", "test")
+
+	def testDefaultProfileIsNamedAfterProduct(self):
+		profile = mrfiler.buildProfile({}, self.mrFormat)
+		self.assertEqual(profile["Name"], "product")
+		self.assertEqual(profile["checkpointFile"], "product-Checkpoint.txt")
+
+	def testProfilesOfOneProductKeepTheirOwnFiles(self):
+		self.write("profiles.ini", "[core]\nalias = core.mr\nproduct = att\n\n[edge]\nalias = edge.mr\nproduct = att\n")
+		(core, edge) = mrfiler.loadProfiles(self.path("profiles.ini"), self.mrFormat)
+		self.assertEqual((core["Product"], edge["Product"]), ("att", "att"))
+		for name in ("filedMRsFile", "checkpointFile", "journalFile", "spoolFile", "ddtsMirrorFile", "metricsFile", "planFile", "promMetricsFile"):
+			self.assertTrue(core[name].startswith("core-"))
+			self.assertTrue(edge[name].startswith("edge-"))
+
+	def testFakeBackendKeepsItsOwnFiles(self):
+		with mock.patch("mrfiler.cdets", mrfiler.setupCdetsBackend("fake")):
+			profile = mrfiler.buildProfile({}, self.mrFormat)
+			self.write("profiles.ini", "[core]\nalias = core.mr\n")
+			(core,) = mrfiler.loadProfiles(self.path("profiles.ini"), self.mrFormat)
+		self.assertEqual(profile["Name"], "fake-product")
+		self.assertEqual(profile["filedMRsFile"], "fake-product-Filed-MRs.txt")
+		self.assertEqual(core["checkpointFile"], "fake-core-Checkpoint.txt")
+
+	def testProfileFormatAndRules(self):
+		other = mrfiler.setupFormat("ATTip", {"Alias": "attip.mr", "Server": "server", "Project": "CSC.swtools", "Product": "attip"},
+			[("ATTip", "^ATTip\\d{5}:", ["^ATTip\\d{5}"], "ATTip*")], False, False, False, "*%s*", "other")
+		self.write("rules.ini", "[TEST]\nnew = Created: CC-\\d+\nkey = CC-\\d+\n")
+		self.write("profiles.ini", "[test]\n\n[attip]\nformat = ATTip\n\n[own]\nrules = %s\n" % self.path("rules.ini"))
+		with mock.patch("mrfiler.importlib.import_module", return_value=mock.Mock(mrFormat=other)) as importModule:
+			(test, attip, own) = mrfiler.loadProfiles(self.path("profiles.ini"), self.mrFormat)
+		importModule.assert_called_once_with("Scrubber")
+		self.assertIs(test["Format"], self.mrFormat)
+		self.assertIs(attip["Format"], other)
+		self.assertEqual((attip["Alias"], attip["Product"]), ("attip.mr", "attip"))
+		self.assertEqual(mrfiler.classifySubject("ATTip00001: x", attip["rules"]), (True, "ATTip00001", "ATTip"))
+		self.assertEqual(mrfiler.classifySubject("Created: CC-7", own["rules"]), (True, "CC-7", "TEST"))
+		self.assertEqual(mrfiler.classifySubject("New: MR-7", own["rules"]), (False, False, False))
+
+	def testUnknownFormat(self):
+		self.write("profiles.ini", "[test]\nformat = NONE\n")
+		with mock.patch("sys.stderr", io.StringIO()):
+			self.assertRaises(SystemExit, mrfiler.loadProfiles, self.path("profiles.ini"), self.mrFormat)
+
+class TeardownTest(StateFileTest):
+
+	def profile(self):
+		mrFormat = mrfiler.setupFormat("TEST", {"Alias": "alias", "Server": "server", "Project": "CSC.swtools", "Product": "product"},
+			[("TEST", "New: MR-\\d+", ["MR-\\d+"], "New: *")], False, False, False, "*%s *", "test")
+		profile = mrfiler.buildProfile({}, mrFormat)
+		for name in ("filedMRsFile", "checkpointFile", "journalFile", "spoolFile"):
+			profile[name] = self.path(profile[name])
+		return profile
+
+	def testFailedRunClosesWhatItOpened(self):
+		spool = mock.Mock()
+		with mock.patch("mrfiler.LOG", 0), mock.patch("mrfiler.SPOOL", 1), mock.patch("mrfiler.openSpool", return_value=spool), \
+				mock.patch("mrfiler.setupMailer", side_effect=OSError("connection refused")), \
+				mock.patch("mrfiler.closeProfileState") as closeProfileState:
+			self.assertRaises(SystemExit, mrfiler.runProfile, self.profile())
+		spool.close.assert_called_once_with()
+		closeProfileState.assert_called_once()
+
+	def testFilingsOfAFailedRunAreRecorded(self):
+		# MR-1 is filed on the pool, the run fails on MR-2 after that
+		filed = threading.Event()
+		def createMany(cdets, items):
+			filed.set()
+			return [True]
+		def buildDDTSTemplate(projectDict, mrDict, MR):
+			if (MR == "MR-2"):
+				filed.wait(5)
+				raise ValueError("bad template")
+			return "template"
+		profile = self.profile()
+		profile["Format"]["buildDDTSTemplate"] = buildDDTSTemplate
+		profile["Format"]["buildDDTSAttribute"] = lambda projectDict, mrDict, MR: "%s att-core" % MR
+		classified = []
+		parsedBodies = {}
+		for id in (1, 2):
+			MR = "MR-%d" % id
+			classified.append((id, {"subject": "New: " + MR, "from": "user"}, (MR, "user", "New: " + MR)))
+			parsedBodies[id] = (False, {}, "")
+		cdets = {"existsMany": lambda cdets, MRs, *args: dict.fromkeys(MRs, False), "createMany": createMany}
+		ddtsMirror = mock.Mock()
+		with mock.patch("mrfiler.LOG", 0), mock.patch("mrfiler.PLAN_REPORT", 0), mock.patch("mrfiler.cdets", cdets), \
+				mock.patch("mrfiler.DDTS_MIRROR", 1), mock.patch("mrfiler.openDDTSMirror", return_value=ddtsMirror), \
+				mock.patch("mrfiler.refreshDDTSMirror", return_value=True), \
+				mock.patch("mrfiler.checkIfDDTSExistsMirror", lambda db, MRs, match: dict.fromkeys(MRs, False)), \
+				mock.patch("mrfiler.addDDTSMirror") as addDDTSMirror:
+			state = mrfiler.openProfileState(profile)
+			self.addCleanup(mrfiler.closeProfileState, state)
+			self.assertRaises(ValueError, mrfiler.runProfile, profile, state=state, backfill=(classified, parsedBodies))
+		self.assertEqual(state["knownMRs"], set(["MR-1"]))
+		addDDTSMirror.assert_called_once_with(ddtsMirror, "MR-1", "MR-1 att-core")
+		state["mrfh"].flush()
+		self.assertEqual(mrfiler.readKnownMRs(profile["filedMRsFile"])[0], set(["MR-1"]))
+
+	def runIngested(self, parsedIds):
+		# Runs a profile of a multi-profile ASYNC_NNTP run on the articles
+		# 1 and 2 the asyncio reader got, with the bodies of parsedIds.
+		# Returns the mailer pool and the connections the run opened
+		profile = self.profile()
+		profile["Format"]["processBody"] = lambda body: ({}, "")
+		profile["Format"]["buildDDTSTemplate"] = lambda projectDict, mrDict, MR: "template"
+		profile["Format"]["buildDDTSAttribute"] = lambda projectDict, mrDict, MR: MR
+		classified = [(id, {"subject": "New: MR-%d" % id, "from": "user"}, ("MR-%d" % id, "user", "New: MR-%d" % id)) for id in (1, 2)]
+		parsedBodies = dict((id, (False, {}, "")) for id in parsedIds)
+		connections = []
+		def connect(*args, **kwargs):
+			mailer = mock.Mock()
+			mailer.group.return_value = ("211", 2, 1, 2, "alias")
+			mailer.body.return_value = ("222", ArticleInfo(2, "<2@test>", []))
+			connections.append(mailer)
+			return mailer
+		cdets = {"existsMany": lambda cdets, MRs, *args: dict.fromkeys(MRs, False), "createMany": lambda cdets, items: [True]}
+		mailerPool = mrfiler.setupMailerPool(1, 1)
+		with mock.patch("mrfiler.LOG", 0), mock.patch("mrfiler.METRICS", 0), mock.patch("mrfiler.PLAN_REPORT", 0), \
+				mock.patch("mrfiler.DDTS_MIRROR", 0), mock.patch("mrfiler.ASYNC_NNTP", 1), mock.patch("mrfiler.cdets", cdets), \
+				mock.patch("mrfiler.NNTP", side_effect=connect):
+			mrfiler.runSharedProfile(profile, mailerPool, ingested=(1, 2, 1, classified, parsedBodies))
+		return (mailerPool, connections)
+
+	def testIngestedRunNeedsNoConnection(self):
+		(mailerPool, connections) = self.runIngested([1, 2])
+		self.assertEqual(connections, [])
+		self.assertEqual(mailerPool["slots"], {})
+
+	def testIngestedRunBorrowsAConnectionForMissingBodies(self):
+		(mailerPool, connections) = self.runIngested([1])
+		self.assertEqual(len(connections), 1)
+		connections[0].group.assert_called_once_with("alias")
+		connections[0].body.assert_called_once_with(2)
+		connections[0].quit.assert_not_called()
+		self.assertIs(mrfiler.acquireMailer(mailerPool, "server", wait=False), connections[0])
+
+	def testWatchReconnectsAtOnceThenBacksOff(self):
+		delays = []
+		def sleep(delay):
+			delays.append(delay)
+			if (len(delays) == 4):
+				raise KeyboardInterrupt()
+		with mock.patch("mrfiler.LOG", 0), mock.patch("mrfiler.openProfileState"), \
+				mock.patch("mrfiler.NNTP", side_effect=OSError("connection reset")), mock.patch("mrfiler.time.sleep", side_effect=sleep):
+			self.assertRaises(KeyboardInterrupt, mrfiler.watchProfile, self.profile(), 10)
+		self.assertEqual(delays, [0, 20, 40, 80])
+
+	def testWatchSurvivesQuit(self):
+		delays = []
+		def sleep(delay):
+			delays.append(delay)
+			if (len(delays) == 2):
+				raise KeyboardInterrupt()
+		mailer = mock.Mock()
+		mailer.group.return_value = ("211", 10, 1, 10, "alias")
+		with mock.patch("mrfiler.LOG", 0), mock.patch("mrfiler.openProfileState", return_value={"checkpoint": 0}), \
+				mock.patch("mrfiler.NNTP", return_value=mailer), mock.patch("mrfiler.runProfile", side_effect=SystemExit()), \
+				mock.patch("mrfiler.time.sleep", side_effect=sleep):
+			self.assertRaises(KeyboardInterrupt, mrfiler.watchProfile, self.profile(), 10)
+		self.assertEqual(delays, [0, 20])
+		self.assertEqual(mailer.quit.call_count, 2)
+
+class IngestProfilesTest(unittest.TestCase):
+
+	def ingest(self, maxConnections, poolSize):
+		# Returns the results and the peak number of connections to the server
+		self.loops = set()
+		active = {"server": 0, "peak": 0}
+		async def asyncIngest(server, alias, checkpoint, knownMRs, rules, processBody, bodyWorkers, *args):
+			self.loops.add(asyncio.get_running_loop())
+			active[server] += 1 + bodyWorkers
+			active["peak"] = max(active["peak"], active[server])
+			await asyncio.sleep(0.01)
+			active[server] -= 1 + bodyWorkers
+			if (alias == "broken"):
+				raise OSError("connection refused")
+			return (1, 10, 1, [], {alias: bodyWorkers})
+		profiles = [{"Server": "server", "Alias": alias, "rules": False, "Format": {"processBody": False}} for alias in ("a", "broken", "c", "d")]
+		self.states = [{"checkpoint": 0, "knownMRs": set(), "metrics": mrfiler.setupMetrics()} for profile in profiles]
+		with mock.patch("mrfiler.asyncIngest", asyncIngest), mock.patch("mrfiler.maxServerConnections", maxConnections), \
+				mock.patch("mrfiler.bodyPoolSize", poolSize):
+			results = asyncio.run(mrfiler.ingestProfiles(profiles, self.states))
+		return (results, active["peak"])
+
+	def testProfilesShareOneLoop(self):
+		(results, peak) = self.ingest(4, 1)
+		self.assertEqual(len(self.loops), 1)
+		self.assertEqual(peak, 4)
+		self.assertEqual(results[0][4], {"a": 1})
+		self.assertIsInstance(results[1], OSError)
+		self.assertEqual(results[3][4], {"d": 1})
+		self.assertEqual(self.states[2]["metrics"]["stages"]["ingest"]["count"], 1)
+
+	def testBodyReadersFitIntoTheServerConnections(self):
+		(results, peak) = self.ingest(4, 4)
+		self.assertEqual((peak, results[0][4]), (4, {"a": 3}))
+		(results, peak) = self.ingest(1, 4)
+		self.assertEqual((peak, results[0][4]), (1, {"a": 0}))
+
+if __name__ == "__main__":
+	unittest.main()